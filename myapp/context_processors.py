@@ -1,24 +1,31 @@
-from .models import ClientProfile, CompanySettings
+from django.core.cache import cache
+from django.db.models import Prefetch
+from .models import ClientProfile, CompanySettings, HeroCarouselImage, \
+    COMPANY_DATA_CACHE_KEY, COMPANY_DATA_CACHE_TIMEOUT
 
 def user_tokens(request):
     if request.user.is_authenticated and not request.user.is_staff:
         try:
-            profile = request.user.clientprofile
-            # Check reset on every request (or optimize to do it less often)
-            profile.check_and_reset_tokens()
-            return {'tokens_remaining': profile.tokens_remaining}
+            # Reset check + remaining tokens with one TokenSettings read (the async
+            # check_and_reset_tokens() can't be called from this sync context)
+            return {'tokens_remaining': request.user.clientprofile.check_reset_and_get_tokens_remaining()}
         except ClientProfile.DoesNotExist:
             return {'tokens_remaining': 0}
     return {}
 
-def company_data(request):
-    # Carga la primera (y única) instancia de CompanySettings
-    settings = CompanySettings.objects.first()
-    
+def load_company_data():
+    # Carga la primera (y única) instancia de CompanySettings, con las imágenes del carrusel
+    # (solo las columnas que se pintan) y las de auth prefetcheadas
+    settings = CompanySettings.objects.prefetch_related(
+        Prefetch('hero_images',
+                 queryset=HeroCarouselImage.objects.only('id', 'company_settings', 'image', 'caption', 'order')),
+        'auth_images'
+    ).first()
+
     # Cargar imágenes del carrusel si existen
     hero_images = []
     auth_images = []
-    
+
     if settings:
         hero_images = list(settings.hero_images.all())
         auth_images = list(settings.auth_images.all())
@@ -29,3 +36,7 @@ def company_data(request):
         'hero_images': hero_images,
         'auth_images': auth_images
     }
+
+def company_data(request):
+    # Runs on every template render: cached, invalidated by signals in models.py
+    return cache.get_or_set(COMPANY_DATA_CACHE_KEY, load_company_data, COMPANY_DATA_CACHE_TIMEOUT)
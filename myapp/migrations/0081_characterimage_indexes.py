@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-16 14:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0080_remove_character_promp_character_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='characterimage',
+            index=models.Index(fields=['user', '-id'], name='myapp_chara_user_id_15d68c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='characterimage',
+            index=models.Index(fields=['character', 'user', '-id'], name='myapp_chara_charact_4ec88a_idx'),
+        ),
+    ]
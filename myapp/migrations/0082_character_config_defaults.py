@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-16 14:22
+
+import json
+
+from django.db import migrations, models
+
+
+def fill_config_defaults(apps, schema_editor):
+    Character = apps.get_model('myapp', 'Character')
+    characters = list(Character.objects.only('id', 'character_config'))
+    for character in characters:
+        width, height, seed = 1024, 1024, -1
+        try:
+            config = json.loads(character.character_config or '{}')
+            width = int(config.get('width', width))
+            height = int(config.get('height', height))
+            if config.get('seed_behavior') == 'fixed' and 'seed' in config:
+                seed = int(config['seed'])
+        except (ValueError, TypeError, AttributeError):
+            pass
+        character.default_width, character.default_height, character.default_seed = width, height, seed
+    Character.objects.bulk_update(characters, ['default_width', 'default_height', 'default_seed'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0081_characterimage_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='default_height',
+            field=models.IntegerField(default=1024, editable=False),
+        ),
+        migrations.AddField(
+            model_name='character',
+            name='default_seed',
+            field=models.IntegerField(default=-1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='character',
+            name='default_width',
+            field=models.IntegerField(default=1024, editable=False),
+        ),
+        migrations.RunPython(fill_config_defaults, migrations.RunPython.noop),
+    ]
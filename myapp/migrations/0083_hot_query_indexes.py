@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-16 14:54
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0082_character_config_defaults'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['user', 'character', 'timestamp'], name='myapp_chatm_user_id_04580c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userpremiumgrant',
+            index=models.Index(fields=['user', 'expires_at'], name='myapp_userp_user_id_8e6f55_idx'),
+        ),
+    ]
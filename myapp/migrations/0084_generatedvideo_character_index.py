@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-16 15:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0083_hot_query_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='generatedvideo',
+            index=models.Index(fields=['character', 'user', '-created_at'], name='myapp_gener_charact_c32299_idx'),
+        ),
+    ]
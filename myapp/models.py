@@ -2,12 +2,16 @@ from django.db import models
 from django.db.models import Q
 from django.contrib.auth.models import User
 import os
+import json
 from django.utils import timezone
 from datetime import timedelta
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.core.cache import cache
 from asgiref.sync import sync_to_async
 import secrets
+import threading
+from contextlib import contextmanager
 import string
 from django.core.validators import MinValueValidator, MaxValueValidator # IMPORTANTE
 import uuid
@@ -63,6 +67,32 @@ class CharacterSubCategory(models.Model):
     def __str__(self):
         return self.name
 
+# --- CATEGORY LISTS CACHE (filter bars of the generate / workspace / gallery pages) ---
+CATEGORY_LISTS_CACHE_KEY = 'category_lists'
+CATEGORY_LISTS_CACHE_TIMEOUT = 300
+
+@receiver([post_save, post_delete], sender=CharacterCategory)
+@receiver([post_save, post_delete], sender=CharacterSubCategory)
+def invalidate_category_lists_cache(sender, **kwargs):
+    cache.delete(CATEGORY_LISTS_CACHE_KEY)
+
+def parse_character_config_defaults(config_str):
+    """Returns (width, height, seed) from a character_config JSON string (seed -1 = random)."""
+    width, height, seed = 1024, 1024, -1
+    if not config_str:
+        return width, height, seed
+    try:
+        config = json.loads(config_str)
+        if 'width' in config: width = int(config['width'])
+        if 'height' in config: height = int(config['height'])
+
+        # Seed logic:
+        if config.get('seed_behavior') == 'fixed' and 'seed' in config:
+            seed = int(config['seed'])
+    except (json.JSONDecodeError, ValueError, TypeError, AttributeError):
+        pass
+    return width, height, seed
+
 class Character(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True, null=True, help_text="Internal character description, style notes, etc.")
@@ -79,6 +109,19 @@ class Character(models.Model):
     is_private = models.BooleanField(default=False, verbose_name="Private Character", help_text="If checked, this character will NOT appear in the public list. Users need a code to access it.")
     enable_blacklist = models.BooleanField(default=False, verbose_name="Enable Blacklist", help_text="Enable a global negative prompt (blacklist) for this character.")
 
+    # --- NEW: Defaults denormalized from character_config (filled on save, read by the workspace) ---
+    default_width = models.IntegerField(default=1024, editable=False)
+    default_height = models.IntegerField(default=1024, editable=False)
+    default_seed = models.IntegerField(default=-1, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.default_width, self.default_height, self.default_seed = parse_character_config_defaults(
+            self.character_config)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'character_config' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'default_width', 'default_height', 'default_seed'}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.name
 
@@ -110,6 +153,19 @@ def delete_character_catalog_image_file(sender, instance, **kwargs):
             except Exception as e:
                 print(f"Error deleting catalog image file: {e}")
 
+# --- PUBLIC CHARACTERS CACHE (character list served to anonymous visitors) ---
+PUBLIC_CHARACTERS_CACHE_KEY = 'public_characters'
+PUBLIC_CHARACTERS_CACHE_TIMEOUT = 300
+
+# Proxy saves send sender=PrivateCharacter (the admin edits private characters through it)
+@receiver([post_save, post_delete], sender=Character)
+@receiver([post_save, post_delete], sender=PrivateCharacter)
+@receiver([post_save, post_delete], sender=CharacterCatalogImage)
+@receiver([post_save, post_delete], sender=CharacterCategory)
+@receiver([post_save, post_delete], sender=CharacterSubCategory)
+def invalidate_public_characters_cache(sender, **kwargs):
+    cache.delete(PUBLIC_CHARACTERS_CACHE_KEY)
+
 class CharacterImage(models.Model):
     # CAMBIO: Agregado 'Gen_EyeDetailer' a las opciones
     TYPE_CHOICES = [
@@ -133,11 +189,36 @@ class CharacterImage(models.Model):
     # --- NUEVO: Campo para ocultar del admin y galería pública ---
     is_hidden_from_admin = models.BooleanField(default=False, verbose_name="Hidden (Private Mode)", help_text="If true, this image is hidden from the admin list and public gallery.")
 
+    class Meta:
+        indexes = [
+            # Gallery: filter by user, newest first
+            models.Index(fields=['user', '-id']),
+            # Generate GET: filter by character + user, newest first
+            models.Index(fields=['character', 'user', '-id']),
+        ]
+
     def __str__(self):
         if self.user:
             return f"Image by {self.user.username} for {self.character.name}"
         return f"{self.character.name} - {os.path.basename(self.image.name)}"
 
+# --- BULK MEDIA DELETES: FILES REMOVED BY THE CALLER ---
+# The user-facing delete views collect the storage names, delete the rows and then remove every file
+# once, in parallel. Inside this block the post_delete receivers below leave the files alone; any other
+# delete (admin, cascades) still cleans up through them.
+_media_file_cleanup = threading.local()
+
+@contextmanager
+def caller_deletes_media_files():
+    _media_file_cleanup.deferred = True
+    try:
+        yield
+    finally:
+        _media_file_cleanup.deferred = False
+
+def media_file_cleanup_deferred():
+    return getattr(_media_file_cleanup, 'deferred', False)
+
 # --- PROXY MODEL FOR PRIVATE IMAGES ---
 class PrivateCharacterImage(CharacterImage):
     class Meta:
@@ -148,6 +229,8 @@ class PrivateCharacterImage(CharacterImage):
 @receiver(post_delete, sender=CharacterImage)
 def delete_character_image_files(sender, instance, **kwargs):
     """Deletes image and workflow files from disk when a CharacterImage is deleted."""
+    if media_file_cleanup_deferred():
+        return
     # Delete the main image file
     if instance.image:
         if os.path.isfile(instance.image.path):
@@ -234,12 +317,20 @@ class GeneratedVideo(models.Model):
     workflow_used = models.ForeignKey(VideoWorkflow, on_delete=models.SET_NULL, null=True, blank=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Videos of a user for one character, newest first (generate page video list)
+            models.Index(fields=['character', 'user', '-created_at']),
+        ]
     
     def __str__(self):
         return f"Video by {self.user.username} - {self.created_at.strftime('%Y-%m-%d %H:%M')}"
 
 @receiver(post_delete, sender=GeneratedVideo)
 def delete_generated_video_files(sender, instance, **kwargs):
+    if media_file_cleanup_deferred():
+        return
     if instance.video_file:
         if os.path.isfile(instance.video_file.path):
             try:
@@ -292,8 +383,20 @@ class TokenSettings(models.Model):
     @classmethod
     def load(cls):
         # Load the only instance, or create it if it doesn't exist
-        obj, created = cls.objects.get_or_create(pk=1)
-        return obj
+        # Read on every token/permission check: cached, invalidated on save
+        return cache.get_or_set(
+            TOKEN_SETTINGS_CACHE_KEY,
+            lambda: cls.objects.get_or_create(pk=1)[0],
+            TOKEN_SETTINGS_CACHE_TIMEOUT,
+        )
+
+# --- TOKEN SETTINGS CACHE (singleton read by TokenSettings.load) ---
+TOKEN_SETTINGS_CACHE_KEY = 'token_settings'
+TOKEN_SETTINGS_CACHE_TIMEOUT = 300
+
+@receiver(post_save, sender=TokenSettings)
+def invalidate_token_settings_cache(sender, **kwargs):
+    cache.delete(TOKEN_SETTINGS_CACHE_KEY)
 
 class ClientProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='clientprofile')
@@ -318,7 +421,15 @@ class ClientProfile(models.Model):
 
     @sync_to_async
     def check_and_reset_tokens(self):
+        self.reset_tokens_if_due(TokenSettings.load())
+
+    # --- NEW: Reset + remaining tokens loading TokenSettings only once ---
+    def check_reset_and_get_tokens_remaining(self):
         settings = TokenSettings.load()
+        self.reset_tokens_if_due(settings)
+        return (settings.default_token_allowance + self.bonus_tokens) - self.tokens_used
+
+    def reset_tokens_if_due(self, settings):
         now = timezone.now()
         should_reset = False
         
@@ -346,6 +457,20 @@ def create_or_update_user_profile(sender, instance, created, **kwargs):
     if created and not instance.is_staff:
         ClientProfile.objects.create(user=instance)
 
+# --- OWNER STAFF CACHE (used by serve_private_media) ---
+# Authorization data: the post_save refresh only reaches the local cache when it is per-process (LocMemCache),
+# so the TTL bounds how long another worker can keep a demoted staff user's media public
+USER_STAFF_CACHE_KEY = 'user_staff_{pk}'
+USER_STAFF_CACHE_TIMEOUT = 30
+
+@receiver(post_save, sender=User)
+def refresh_user_staff_cache(sender, instance, **kwargs):
+    cache.set(USER_STAFF_CACHE_KEY.format(pk=instance.pk), instance.is_staff, USER_STAFF_CACHE_TIMEOUT)
+
+@receiver(post_delete, sender=User)
+def invalidate_user_staff_cache(sender, instance, **kwargs):
+    cache.delete(USER_STAFF_CACHE_KEY.format(pk=instance.pk))
+
 class ConnectionConfig(models.Model):
     name = models.CharField(max_length=100, help_text="Ex: Local, Company GPU")
     base_url = models.CharField(max_length=255, help_text="Ex: http://127.0.0.1:8188 or https://your-url.trycloudflare.com")
@@ -362,6 +487,14 @@ class ConnectionConfig(models.Model):
         status = " (ACTIVE)" if self.is_active else ""
         return f"{self.name} - {self.base_url}{status}"
 
+# --- COMFYUI CHECKPOINTS CACHE (checkpoint list of get_models_view) ---
+COMFY_CHECKPOINTS_CACHE_KEY = 'comfy_checkpoints'
+COMFY_CHECKPOINTS_CACHE_TIMEOUT = 60
+
+@receiver([post_save, post_delete], sender=ConnectionConfig)
+def invalidate_comfy_checkpoints_cache(sender, **kwargs):
+    cache.delete(COMFY_CHECKPOINTS_CACHE_KEY)
+
 class CompanySettings(models.Model):
     name = models.CharField(max_length=200, verbose_name="Company Name", default="My Company")
     logo = models.ImageField(upload_to='company_logos/', verbose_name="Logo", blank=True, null=True)
@@ -470,6 +603,18 @@ class HeroCarouselImage(models.Model):
             os.remove(self.image.path)
         super().delete(*args, **kwargs)
 
+# --- HERO CAROUSEL CACHE (used by generate_image_view) ---
+HERO_ITEMS_CACHE_KEY = 'hero_items:{pk}'
+HERO_ITEMS_CACHE_TIMEOUT = 300
+
+@receiver([post_save, post_delete], sender=CompanySettings)
+def invalidate_hero_items_from_settings(sender, instance, **kwargs):
+    cache.delete(HERO_ITEMS_CACHE_KEY.format(pk=instance.pk))
+
+@receiver([post_save, post_delete], sender=HeroCarouselImage)
+def invalidate_hero_items_from_image(sender, instance, **kwargs):
+    cache.delete(HERO_ITEMS_CACHE_KEY.format(pk=instance.company_settings_id))
+
 class ShowcaseItem(models.Model):
     company_settings = models.ForeignKey(CompanySettings, related_name='showcase_items', on_delete=models.CASCADE)
     image = models.ImageField(upload_to='showcase/', verbose_name="Showcase Image")
@@ -486,6 +631,19 @@ class ShowcaseItem(models.Model):
             os.remove(self.image.path)
         super().delete(*args, **kwargs)
 
+# --- COMPANY SETTINGS CACHE (settings row + showcase items, used by the async views) ---
+COMPANY_SETTINGS_CACHE_KEY = 'company_settings'
+COMPANY_SETTINGS_CACHE_TIMEOUT = 300
+# Rendered payment / subscription result pages (they only depend on the branding in CompanySettings)
+PAYMENT_RESULT_PAGES = ('payment_done', 'payment_canceled', 'subscription_done', 'subscription_canceled')
+PAYMENT_RESULT_PAGE_CACHE_KEY = 'payment_result_page:{}'
+
+@receiver([post_save, post_delete], sender=CompanySettings)
+@receiver([post_save, post_delete], sender=ShowcaseItem)
+def invalidate_company_settings_cache(sender, **kwargs):
+    cache.delete_many([COMPANY_SETTINGS_CACHE_KEY] +
+                      [PAYMENT_RESULT_PAGE_CACHE_KEY.format(page) for page in PAYMENT_RESULT_PAGES])
+
 # --- NEW: CRYPTO GUIDE IMAGES ---
 class CryptoGuideImage(models.Model):
     company_settings = models.ForeignKey(CompanySettings, related_name='crypto_guide_images', on_delete=models.CASCADE)
@@ -529,6 +687,16 @@ class AuthPageImage(models.Model):
             os.remove(self.image.path)
         super().delete(*args, **kwargs)
 
+# --- COMPANY DATA CACHE (settings + carousel/auth images, used by the company_data context processor) ---
+COMPANY_DATA_CACHE_KEY = 'company_data'
+COMPANY_DATA_CACHE_TIMEOUT = 300
+
+@receiver([post_save, post_delete], sender=CompanySettings)
+@receiver([post_save, post_delete], sender=HeroCarouselImage)
+@receiver([post_save, post_delete], sender=AuthPageImage)
+def invalidate_company_data_cache(sender, **kwargs):
+    cache.delete(COMPANY_DATA_CACHE_KEY)
+
 class ChatMessage(models.Model):
     # --- CAMBIO: Tipo de chat (Imagen o Video) ---
     CHAT_TYPE_CHOICES = [
@@ -554,6 +722,10 @@ class ChatMessage(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
     class Meta:
         ordering = ['timestamp'] # Chronological order
+        indexes = [
+            # Chat history (user + character, chronological) and recent chats per user (leading user column)
+            models.Index(fields=['user', 'character', 'timestamp']),
+        ]
     def __str__(self):
         sender = self.user.username if self.is_from_user else f"AI ({self.character.name})"
         return f"{sender} [{self.chat_type}]: {self.message[:30]}..."
@@ -621,6 +793,10 @@ class UserPremiumGrant(models.Model):
     class Meta:
         verbose_name = "User Premium Grant"
         verbose_name_plural = "User Premium Grants"
+        indexes = [
+            # Active grants of a user (expires_at__gt=now) on every permission check
+            models.Index(fields=['user', 'expires_at']),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.grant_name} (Expires: {self.expires_at.strftime('%Y-%m-%d')})"
@@ -695,6 +871,14 @@ class TokenPackage(models.Model):
     def __str__(self):
         return f"{self.name} - {self.tokens} Tokens for ${self.price}"
 
+# --- TOKEN PACKAGES CACHE (active packages listed on the checkout pages) ---
+TOKEN_PACKAGES_CACHE_KEY = 'token_packages'
+TOKEN_PACKAGES_CACHE_TIMEOUT = 300
+
+@receiver([post_save, post_delete], sender=TokenPackage)
+def invalidate_token_packages_cache(sender, **kwargs):
+    cache.delete(TOKEN_PACKAGES_CACHE_KEY)
+
 class PaymentTransaction(models.Model):
     STATUS_CHOICES = [
         ('PENDING', 'Pending'),
@@ -766,6 +950,14 @@ class SubscriptionPlan(models.Model):
         if self.allow_eye_detail: caps.append("Eye Detailer")
         return " + ".join(caps)
 
+# --- SUBSCRIPTION PLANS CACHE (active plans, ordered by price) ---
+SUBSCRIPTION_PLANS_CACHE_KEY = 'subscription_plans'
+SUBSCRIPTION_PLANS_CACHE_TIMEOUT = 300
+
+@receiver([post_save, post_delete], sender=SubscriptionPlan)
+def invalidate_subscription_plans_cache(sender, **kwargs):
+    cache.delete(SUBSCRIPTION_PLANS_CACHE_KEY)
+
 class UserSubscription(models.Model):
     STATUS_CHOICES = [
         ('ACTIVE', 'Active'),
@@ -804,6 +996,14 @@ class PaymentMethod(models.Model):
         status = " (ACTIVE)" if self.is_active else " (INACTIVE)"
         return f"{self.name}{status}"
 
+# --- ACTIVE PAYMENT METHODS CACHE (config keys read by the payment / subscription views) ---
+PAYMENT_METHODS_CACHE_KEY = 'active_payment_methods'
+PAYMENT_METHODS_CACHE_TIMEOUT = 300
+
+@receiver([post_save, post_delete], sender=PaymentMethod)
+def invalidate_payment_methods_cache(sender, **kwargs):
+    cache.delete(PAYMENT_METHODS_CACHE_KEY)
+
 # --- VIDEO CONFIGURATION (GROUPED) ---
 
 class VideoConfiguration(models.Model):
@@ -853,4 +1053,13 @@ class VideoQualityOption(models.Model):
         verbose_name_plural = "Quality Options"
 
     def __str__(self):
-        return f"{self.name} ({self.value})"
\ No newline at end of file
+        return f"{self.name} ({self.value})"
+
+# --- VIDEO OPTIONS CACHE (duration / quality selectors of the workspace) ---
+VIDEO_OPTIONS_CACHE_KEY = 'video_options'
+VIDEO_OPTIONS_CACHE_TIMEOUT = 300
+
+@receiver([post_save, post_delete], sender=VideoDurationOption)
+@receiver([post_save, post_delete], sender=VideoQualityOption)
+def invalidate_video_options_cache(sender, **kwargs):
+    cache.delete(VIDEO_OPTIONS_CACHE_KEY)
@@ -9,6 +9,19 @@ from .models import ConnectionConfig
 
 # --- FUNCIONES DE CONFIGURACIÓN Y RED ---
 
+# Configuración HTTP común con ComfyUI
+COMFY_HTTP_TIMEOUT = 600.0
+COMFY_HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+COMFY_HTTP_HEADERS = {"ngrok-skip-browser-warning": "true", "User-Agent": "NayelinaApp/1.0"}
+
+def comfy_http_client():
+    """
+    Nuevo httpx.AsyncClient con la configuración común; usar con `async with` para que se cierre al terminar.
+    Bajo WSGI cada vista async corre en su propio event loop, así que un cliente no puede sobrevivir a la llamada:
+    las conexiones solo se reutilizan dentro de una misma generación (queue / history / view).
+    """
+    return httpx.AsyncClient(timeout=COMFY_HTTP_TIMEOUT, limits=COMFY_HTTP_LIMITS, headers=COMFY_HTTP_HEADERS)
+
 def get_protocols(address):
     """Determina si usar HTTP/WS o HTTPS/WSS basado en la dirección."""
     if "runpod.net" in address or "cloudflare" in address or "ngrok" in address or "nayelina.com" in address:
@@ -51,7 +64,7 @@ async def get_active_comfyui_address():
     if len(configs) == 1:
         return configs[0].base_url.rstrip('/')
 
-    async with httpx.AsyncClient() as client:
+    async with comfy_http_client() as client:
         tasks = [check_gpu_load(client, config) for config in configs]
         results = await asyncio.gather(*tasks)
 
@@ -67,38 +80,38 @@ async def get_comfyui_object_info(address):
     protocol, _ = get_protocols(address)
     headers = {"ngrok-skip-browser-warning": "true", "User-Agent": "MyApp/1.0"}
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{protocol}://{address}/object_info", headers=headers)
-            response.raise_for_status()
-            data = response.json()
-
-            # --- MEJORA: Búsqueda más amplia de modelos ---
-            checkpoints = []
-            if "CheckpointLoaderSimple" in data:
-                checkpoints.extend(data["CheckpointLoaderSimple"]["input"]["required"]["ckpt_name"][0])
-            if "UNETLoader" in data:
-                checkpoints.extend(data["UNETLoader"]["input"]["required"]["unet_name"][0])
-            checkpoints = list(set(checkpoints))
-
-            vaes = data.get("VAELoader", {}).get("input", {}).get("required", {}).get("vae_name", [[]])[0]
-
-            loras = []
-            if "LoraLoader" in data:
-                loras.extend(data["LoraLoader"]["input"]["required"]["lora_name"][0])
-            if "LoraLoaderModelOnly" in data:
-                loras.extend(data["LoraLoaderModelOnly"]["input"]["required"]["lora_name"][0])
-            loras = list(set(loras))
-
-            samplers = data.get("KSampler", {}).get("input", {}).get("required", {}).get("sampler_name", [[]])[0]
-            schedulers = data.get("KSampler", {}).get("input", {}).get("required", {}).get("scheduler", [[]])[0]
-
-            return {
-                "checkpoints": checkpoints,
-                "vaes": vaes,
-                "loras": loras,
-                "samplers": samplers,
-                "schedulers": schedulers,
-            }
+        async with comfy_http_client() as client:
+            response = await client.get(f"{protocol}://{address}/object_info", headers=headers, timeout=5.0)
+        response.raise_for_status()
+        data = response.json()
+
+        # --- MEJORA: Búsqueda más amplia de modelos ---
+        checkpoints = []
+        if "CheckpointLoaderSimple" in data:
+            checkpoints.extend(data["CheckpointLoaderSimple"]["input"]["required"]["ckpt_name"][0])
+        if "UNETLoader" in data:
+            checkpoints.extend(data["UNETLoader"]["input"]["required"]["unet_name"][0])
+        checkpoints = list(set(checkpoints))
+
+        vaes = data.get("VAELoader", {}).get("input", {}).get("required", {}).get("vae_name", [[]])[0]
+
+        loras = []
+        if "LoraLoader" in data:
+            loras.extend(data["LoraLoader"]["input"]["required"]["lora_name"][0])
+        if "LoraLoaderModelOnly" in data:
+            loras.extend(data["LoraLoaderModelOnly"]["input"]["required"]["lora_name"][0])
+        loras = list(set(loras))
+
+        samplers = data.get("KSampler", {}).get("input", {}).get("required", {}).get("sampler_name", [[]])[0]
+        schedulers = data.get("KSampler", {}).get("input", {}).get("required", {}).get("scheduler", [[]])[0]
+
+        return {
+            "checkpoints": checkpoints,
+            "vaes": vaes,
+            "loras": loras,
+            "samplers": samplers,
+            "schedulers": schedulers,
+        }
     except Exception as e:
         print(f"ERROR in get_comfyui_object_info: {e}")
         return {"checkpoints": [], "vaes": [], "loras": [], "samplers": [], "schedulers": []}
@@ -116,6 +129,14 @@ async def queue_prompt(client, prompt_workflow, client_id, address):
         print(error_msg)
         raise Exception(error_msg)
 
+async def cancel_prompt(client, prompt_id, address):
+    """Quita un prompt de la cola de ComfyUI (best effort; uno ya en ejecución termina igualmente)."""
+    protocol, _ = get_protocols(address)
+    try:
+        await client.post(f"{protocol}://{address}/queue", json={"delete": [prompt_id]}, timeout=5.0)
+    except Exception as e:
+        print(f"WARNING: no se pudo cancelar el prompt {prompt_id}: {e}")
+
 async def get_image(client, filename, subfolder, folder_type, address):
     protocol, _ = get_protocols(address)
     params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
@@ -727,29 +748,33 @@ async def generate_image_from_character(character, user_prompt, width=None, heig
     _, ws_protocol = get_protocols(address)
     uri = f"{ws_protocol}://{address}/ws?clientId={client_id}"
     images_data = []
-    headers = {"ngrok-skip-browser-warning": "true", "User-Agent": "NayelinaApp/1.0"}
 
-    async with websockets.connect(uri) as websocket:
-        async with httpx.AsyncClient(timeout=600.0, headers=headers) as client:
-            queued_prompt = await queue_prompt(client, updated_workflow, client_id, address)
-            prompt_id = queued_prompt['prompt_id']
+    # One HTTP client for the whole generation (timeout 600s + ngrok headers are the client defaults)
+    async with websockets.connect(uri) as websocket, comfy_http_client() as client:
+        queued_prompt = await queue_prompt(client, updated_workflow, client_id, address)
+        prompt_id = queued_prompt['prompt_id']
 
+        try:
             while True:
                 out = await websocket.recv()
                 if isinstance(out, str):
                     message = json.loads(out)
                     if message['type'] == 'executing' and message['data']['node'] is None:
                         break
-
-            history = await get_history(client, prompt_id, address)
-            history = history[prompt_id]
-            for node_id, node_output in history['outputs'].items():
-                if 'images' in node_output:
-                    image = node_output['images'][0]
-                    image_bytes = await get_image(client, image['filename'], image['subfolder'], image['type'], address)
-                    if image_bytes:
-                        final_tag = allowed_types[-1] if allowed_types else "Gen_Normal"
-                        images_data.append((image_bytes, final_tag))
-                        break
+        except asyncio.CancelledError:
+            # Petición cancelada o timeout: que la GPU no genere para nadie
+            await cancel_prompt(client, prompt_id, address)
+            raise
+
+        history = await get_history(client, prompt_id, address)
+        history = history[prompt_id]
+        for node_id, node_output in history['outputs'].items():
+            if 'images' in node_output:
+                image = node_output['images'][0]
+                image_bytes = await get_image(client, image['filename'], image['subfolder'], image['type'], address)
+                if image_bytes:
+                    final_tag = allowed_types[-1] if allowed_types else "Gen_Normal"
+                    images_data.append((image_bytes, final_tag))
+                    break
 
     return images_data, prompt_id, updated_workflow
\ No newline at end of file
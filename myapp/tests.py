@@ -1,3 +1,342 @@
-from django.test import TestCase
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+import httpx
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import Http404
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from . import video_services, views
+from .models import Character, CharacterAccessCode, CharacterImage, ChatMessage, ClientProfile, Coupon, \
+    CouponRedemption, GeneratedVideo, PrivateCharacter, UserCharacterAccess, UserPremiumGrant, Workflow
+
+
+class ParseByteRangeTests(TestCase):
+    def test_no_header(self):
+        self.assertIsNone(views.parse_byte_range(None, 1000))
+        self.assertIsNone(views.parse_byte_range('', 1000))
+
+    def test_closed_range(self):
+        self.assertEqual(views.parse_byte_range('bytes=0-99', 1000), (0, 99))
+
+    def test_open_ended_range(self):
+        self.assertEqual(views.parse_byte_range('bytes=500-', 1000), (500, 999))
+
+    def test_end_is_clamped_to_size(self):
+        self.assertEqual(views.parse_byte_range('bytes=900-5000', 1000), (900, 999))
+
+    def test_suffix_range(self):
+        self.assertEqual(views.parse_byte_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(views.parse_byte_range('bytes=-5000', 1000), (0, 999))
+
+    def test_invalid_specs_are_ignored(self):
+        # RFC 7233: last-byte-pos < first-byte-pos is invalid, the header is ignored (200, full file)
+        self.assertIsNone(views.parse_byte_range('bytes=500-100', 1000))
+        self.assertIsNone(views.parse_byte_range('bytes=0-1,5-9', 1000))
+        self.assertIsNone(views.parse_byte_range('items=0-1', 1000))
+        self.assertIsNone(views.parse_byte_range('bytes=-', 1000))
+
+    def test_unsatisfiable(self):
+        with self.assertRaises(ValueError):
+            views.parse_byte_range('bytes=1000-', 1000)
+        with self.assertRaises(ValueError):
+            views.parse_byte_range('bytes=-0', 1000)
+        with self.assertRaises(ValueError):
+            views.parse_byte_range('bytes=-10', 0)
+
+
+@override_settings(PRIVATE_MEDIA_ACCEL_PREFIX='')
+class ServePrivateMediaTests(TestCase):
+    CONTENT = bytes(range(256)) * 4  # 1024 bytes
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        patcher = mock.patch.object(views, 'MEDIA_ROOT_ABS', self.media_root + os.sep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.owner = User.objects.create_user('owner', password='x')
+        self.path = f'user_images/{self.owner.id}/image.png'
+        os.makedirs(os.path.join(self.media_root, 'user_images', str(self.owner.id)))
+        with open(os.path.join(self.media_root, self.path), 'wb') as f:
+            f.write(self.CONTENT)
+        self.factory = RequestFactory()
+
+    def get(self, user=None, query='', **extra):
+        request = self.factory.get(f'/private-media/{self.path}', QUERY_STRING=query, **extra)
+        request.user = user or AnonymousUser()
+        return views.serve_private_media(request, self.path)
+
+    def body(self, response):
+        content = b''.join(response.streaming_content)
+        response.close()
+        return content
+
+    def test_owner_gets_full_file(self):
+        response = self.get(self.owner)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(self.body(response), self.CONTENT)
+
+    def test_anonymous_without_signature_is_denied(self):
+        with self.assertRaises(Http404):
+            self.get()
+
+    def test_range_returns_206(self):
+        response = self.get(self.owner, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.CONTENT)}')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(self.body(response), self.CONTENT[10:20])
+
+    def test_unsatisfiable_range_returns_416(self):
+        response = self.get(self.owner, HTTP_RANGE=f'bytes={len(self.CONTENT)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.CONTENT)}')
+
+    def test_invalid_range_serves_full_file(self):
+        response = self.get(self.owner, HTTP_RANGE='bytes=500-100')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.CONTENT)
+
+    def test_stale_if_range_serves_full_file(self):
+        response = self.get(self.owner, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.CONTENT)
+
+    def test_matching_etag_returns_304(self):
+        first = self.get(self.owner)
+        first.close()
+        response = self.get(self.owner, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_valid_signature_grants_access(self):
+        url = views.build_signed_media_url(self.path, self.owner.id)
+        query = urlsplit(url).query
+        response = self.get(query=query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.CONTENT)
+
+    def test_expired_signature_is_denied(self):
+        url = views.build_signed_media_url(self.path, self.owner.id)
+        query = urlsplit(url).query
+        with mock.patch.object(views.time, 'time', return_value=time.time() + 3 * views.SIGNED_MEDIA_MAX_AGE):
+            with self.assertRaises(Http404):
+                self.get(query=query)
+
+    def test_signature_is_bound_to_the_path(self):
+        other_url = views.build_signed_media_url(f'user_images/{self.owner.id}/other.png', self.owner.id)
+        sig = parse_qs(urlsplit(other_url).query)['sig'][0]
+        with self.assertRaises(Http404):
+            self.get(query=f'sig={sig}')
+
+    @override_settings(PRIVATE_MEDIA_ACCEL_PREFIX='/protected/')
+    def test_accel_redirect_path_is_percent_encoded(self):
+        self.path = f'user_images/{self.owner.id}/Zoë 50%?.png'
+        with open(os.path.join(self.media_root, self.path), 'wb') as f:
+            f.write(self.CONTENT)
+        response = self.get(self.owner)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         f'/protected/user_images/{self.owner.id}/Zo%C3%AB%2050%25%3F.png')
+
+
+class RedeemCouponTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='x')
+        self.other = User.objects.create_user('bob', password='x')
+        workflow = Workflow.objects.create(name='Base', json_file='workflows/base.json')
+        self.character = PrivateCharacter.objects.create(name='Hidden', base_workflow=workflow, is_private=True)
+
+    def redeem(self, user, code):
+        self.client.force_login(user)
+        return self.client.post(reverse('redeem_coupon'), {'code': code}, secure=True).json()
+
+    def test_coupon_grants_tokens_and_premium(self):
+        coupon = Coupon.objects.create(code='TOKENS', tokens=50, duration_days=7, unlock_upscale=True)
+        result = self.redeem(self.user, 'TOKENS')
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(ClientProfile.objects.get(user=self.user).bonus_tokens, 50)
+        self.assertTrue(UserPremiumGrant.objects.filter(user=self.user, coupon=coupon, grant_upscale=True).exists())
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.times_redeemed, 1)
+
+    def test_coupon_double_redemption(self):
+        coupon = Coupon.objects.create(code='TWICE', tokens=10)
+        self.assertEqual(self.redeem(self.user, 'TWICE')['status'], 'success')
+        result = self.redeem(self.user, 'TWICE')
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('already redeemed', result['message'])
+        self.assertEqual(ClientProfile.objects.get(user=self.user).bonus_tokens, 10)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.times_redeemed, 1)
+
+    def test_coupon_last_free_slot(self):
+        coupon = Coupon.objects.create(code='ONCE', tokens=10, max_redemptions=1)
+        self.assertEqual(self.redeem(self.user, 'ONCE')['status'], 'success')
+        result = self.redeem(self.other, 'ONCE')
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('maximum usage limit', result['message'])
+        # The losing redemption is rolled back entirely
+        self.assertFalse(CouponRedemption.objects.filter(user=self.other, coupon=coupon).exists())
+        self.assertEqual(ClientProfile.objects.get(user=self.other).bonus_tokens, 0)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.times_redeemed, 1)
+
+    def test_coupon_for_user_without_profile(self):
+        ClientProfile.objects.filter(user=self.user).delete()
+        Coupon.objects.create(code='NOPROFILE', tokens=25)
+        self.assertEqual(self.redeem(self.user, 'NOPROFILE')['status'], 'success')
+        self.assertEqual(ClientProfile.objects.get(user=self.user).bonus_tokens, 25)
+
+    def test_access_code_unlocks_character_once(self):
+        CharacterAccessCode.objects.create(character=self.character, code='SECRET')
+        self.assertEqual(self.redeem(self.user, 'SECRET')['status'], 'success')
+        self.assertTrue(UserCharacterAccess.objects.filter(user=self.user, character=self.character).exists())
+        result = self.redeem(self.user, 'SECRET')
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('already have access', result['message'])
+        self.assertEqual(CharacterAccessCode.objects.get(code='SECRET').times_redeemed, 1)
+
+    def test_access_code_last_free_slot(self):
+        CharacterAccessCode.objects.create(character=self.character, code='SINGLE', max_redemptions=1)
+        self.assertEqual(self.redeem(self.user, 'SINGLE')['status'], 'success')
+        result = self.redeem(self.other, 'SINGLE')
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('maximum usage limit', result['message'])
+        self.assertFalse(UserCharacterAccess.objects.filter(user=self.other, character=self.character).exists())
+
+    def test_invalid_code(self):
+        result = self.redeem(self.user, 'NOPE')
+        self.assertEqual(result, {'status': 'error', 'message': 'Invalid code.'})
+
+
+class DeleteGeneratedMediaTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        self.user = User.objects.create_user('carol', password='x')
+        workflow = Workflow.objects.create(name='Base', json_file='workflows/base.json')
+        self.character = Character.objects.create(name='Public', base_workflow=workflow)
+        self.image = CharacterImage.objects.create(
+            character=self.character, user=self.user,
+            image=self.touch(f'user_images/{self.user.id}/Public/a.png'),
+            generation_workflow=self.touch(f'user_workflows/{self.user.id}/Public/a.json'))
+        self.video = GeneratedVideo.objects.create(
+            user=self.user, character=self.character, prompt='p',
+            video_file=self.touch(f'user_videos/{self.user.id}/Public/v.mp4'),
+            thumbnail=self.touch('video_thumbnails/v.jpg'),
+            generation_workflow=self.touch(f'user_video_workflows/{self.user.id}/Public/v.json'))
+        self.message = ChatMessage.objects.create(user=self.user, character=self.character, is_from_user=False)
+        self.message.generated_images.add(self.image)
+        self.message.generated_videos.add(self.video)
+        self.client.force_login(self.user)
+
+    def touch(self, name):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x')
+        return name
+
+    def media_paths(self, *instances):
+        return {os.path.realpath(field.path) for instance in instances
+                for field in (getattr(instance, name) for name in
+                              ('image', 'video_file', 'thumbnail', 'generation_workflow') if hasattr(instance, name))}
+
+    def post_and_count_unlinks(self, url_name, data):
+        real_remove = os.remove
+        removed = Counter()
+
+        def counting_remove(path, *args, **kwargs):
+            removed[os.path.realpath(path)] += 1
+            return real_remove(path, *args, **kwargs)
+
+        with mock.patch('os.remove', side_effect=counting_remove):
+            response = self.client.post(reverse(url_name), data, secure=True)
+        self.assertEqual(response.json()['status'], 'success')
+        return removed
+
+    def test_delete_message_unlinks_each_file_once(self):
+        paths = self.media_paths(self.image, self.video)
+        removed = self.post_and_count_unlinks(
+            'delete_message', {'message_id': self.message.id, 'delete_images': 'true'})
+        self.assertEqual(removed, Counter({path: 1 for path in paths}))
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        self.assertFalse(CharacterImage.objects.exists())
+        self.assertFalse(GeneratedVideo.objects.exists())
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_delete_images_unlinks_each_file_once(self):
+        paths = self.media_paths(self.image)
+        removed = self.post_and_count_unlinks('delete_images', {'image_ids[]': [self.image.id]})
+        self.assertEqual(removed, Counter({path: 1 for path in paths}))
+        self.assertFalse(CharacterImage.objects.exists())
+
+    def test_other_deletes_still_clean_up_through_the_signal(self):
+        paths = self.media_paths(self.image)
+        self.image.delete()
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+
+class GetVideoFileTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        patcher = mock.patch.object(tempfile, 'tempdir', self.tmp_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def download(self, body):
+        async def run():
+            transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body()))
+            async with httpx.AsyncClient(transport=transport) as client:
+                return await video_services.get_video_file(client, 'v.mp4', '', 'output', '127.0.0.1:8188')
+        return asyncio.run(run())
+
+    def test_download_is_kept_for_the_caller(self):
+        async def body():
+            yield b'video'
+        path = self.download(body)
+        self.assertEqual(os.path.dirname(path), self.tmp_dir)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'video')
+
+    def test_failed_download_leaves_no_temp_file(self):
+        async def body():
+            yield b'partial'
+            raise httpx.ReadError('connection lost')
+        self.assertIsNone(self.download(body))
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_cancelled_download_leaves_no_temp_file(self):
+        started = asyncio.Event()
+
+        async def body():
+            yield b'partial'
+            started.set()
+            await asyncio.Event().wait()  # the server stalls
+
+        async def run():
+            transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body()))
+            async with httpx.AsyncClient(transport=transport) as client:
+                download = asyncio.create_task(
+                    video_services.get_video_file(client, 'v.mp4', '', 'output', '127.0.0.1:8188'))
+                await started.wait()
+                download.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await download
+
+        asyncio.run(run())
+        self.assertEqual(os.listdir(self.tmp_dir), [])
@@ -5,6 +5,7 @@ import httpx
 import websockets
 import asyncio
 import os
+import tempfile
 from asgiref.sync import sync_to_async
 from django.core.files.base import ContentFile
 from .models import VideoConnectionConfig, VideoWorkflow
@@ -120,17 +121,53 @@ async def queue_prompt(client, prompt_workflow, client_id, address):
         raise
 
 
+VIDEO_DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+
+def discard_temp_file(path):
+    """Borra un archivo temporal de descarga, si todavía existe."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def close_and_discard_temp_file(tmp):
+    """Cierra y borra un NamedTemporaryFile(delete=False) que no se va a entregar."""
+    tmp.close()
+    discard_temp_file(tmp.name)
+
+
 async def get_video_file(client, filename, subfolder, folder_type, address):
+    """
+    Descarga el video a un archivo temporal por bloques y devuelve su ruta (o None si falla / está vacío).
+    La memoria usada es la de un bloque, no la del video entero; el llamador debe borrar el archivo.
+    Si no se devuelve la ruta (error, video vacío o cancelación) el temporal se borra aquí.
+    """
     protocol, _ = get_protocols(address)
     params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+    tmp = None
+    keep = False
     try:
         # Aumentamos timeout para la descarga del video final
-        response = await client.get(f"{protocol}://{address}/view", params=params, timeout=120.0)
-        response.raise_for_status()
-        return response.content
+        async with client.stream("GET", f"{protocol}://{address}/view", params=params, timeout=120.0) as response:
+            response.raise_for_status()
+            tmp = await asyncio.to_thread(tempfile.NamedTemporaryFile, delete=False,
+                                          suffix=os.path.splitext(filename)[1])
+            async for chunk in response.aiter_bytes(VIDEO_DOWNLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(tmp.write, chunk)
+        size = tmp.tell()
+        await asyncio.to_thread(tmp.close)
+        keep = bool(size)
+        return tmp.name if keep else None
     except Exception as e:
         print(f"Error descargando video: {e}")
         return None
+    finally:
+        # finally (no except): CancelledError es BaseException y también debe limpiar.
+        # El hilo de to_thread termina aunque este await se cancele, así que el borrado no se pierde.
+        if tmp is not None and not keep:
+            await asyncio.to_thread(close_and_discard_temp_file, tmp)
 
 
 async def get_history(client, prompt_id, address):
@@ -325,7 +362,8 @@ async def generate_video_task(user_image_file, prompt, negative_prompt, duration
                               resolution=768):
     """
     Orquesta la generación de video.
-    Retorna: (video_content_bytes, used_seed, video_filename, final_workflow)
+    Retorna: (video_temp_path, used_seed, video_filename, final_workflow)
+    El video queda en un archivo temporal: el llamador lo guarda en el storage y lo borra.
     """
     print(f"🚀 INICIANDO GENERACIÓN DE VIDEO: {prompt[:30]}...")
     
@@ -432,40 +470,40 @@ async def generate_video_task(user_image_file, prompt, negative_prompt, duration
 
             # print(f"DEBUG: ComfyUI Outputs for {prompt_id}: {json.dumps(outputs, indent=2)}")
 
-            video_content = None
+            video_path = None
             video_filename = f"video_{prompt_id}.mp4"
 
             # Buscar salida de video
             for node_id, output_data in outputs.items():
                 if 'gifs' in output_data:
                     for vid in output_data['gifs']:
-                        video_content = await get_video_file(client, vid['filename'], vid['subfolder'], vid['type'],
+                        video_path = await get_video_file(client, vid['filename'], vid['subfolder'], vid['type'],
                                                              address)
                         video_filename = vid['filename']
-                        if video_content: break
+                        if video_path: break
 
-                if not video_content and 'images' in output_data:
+                if not video_path and 'images' in output_data:
                     for img in output_data['images']:
                         fname = img['filename']
                         if fname.endswith('.mp4') or fname.endswith('.gif') or fname.endswith('.webm'):
-                            video_content = await get_video_file(client, fname, img['subfolder'], img['type'], address)
+                            video_path = await get_video_file(client, fname, img['subfolder'], img['type'], address)
                             video_filename = fname
-                            if video_content: break
+                            if video_path: break
 
-                if not video_content and 'video' in output_data:
+                if not video_path and 'video' in output_data:
                     for vid in output_data['video']:
-                        video_content = await get_video_file(client, vid['filename'], vid['subfolder'], vid['type'],
+                        video_path = await get_video_file(client, vid['filename'], vid['subfolder'], vid['type'],
                                                              address)
                         video_filename = vid['filename']
-                        if video_content: break
+                        if video_path: break
 
-                if video_content: break
+                if video_path: break
 
-            if not video_content:
+            if not video_path:
                 raise Exception("No se encontró el archivo de video generado en la respuesta de ComfyUI.")
             
             print("✨ Video descargado correctamente.")
-            return video_content, used_seed, video_filename, final_workflow
+            return video_path, used_seed, video_filename, final_workflow
 
         except Exception as e:
             print(f"❌ Error CRÍTICO en generate_video_task: {e}")
@@ -1,24 +1,52 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.db import models
+from django.template.response import TemplateResponse
+from django.template.loader import render_to_string
+from django.db import models, transaction, IntegrityError
 from .models import Workflow, Character, CharacterImage, ConnectionConfig, CompanySettings, ChatMessage, \
     CharacterCategory, CharacterSubCategory, ClientProfile, Coupon, CouponRedemption, CharacterAccessCode, \
     UserCharacterAccess, TokenPackage, PaymentTransaction, SubscriptionPlan, UserSubscription, TokenSettings, \
-    UserPremiumGrant, PaymentMethod, GeneratedVideo, VideoWorkflow, VideoConfiguration  # IMPORTAR NUEVO MODELO
+    UserPremiumGrant, PaymentMethod, GeneratedVideo, VideoWorkflow, \
+    CharacterCatalogImage, HeroCarouselImage, HERO_ITEMS_CACHE_KEY, HERO_ITEMS_CACHE_TIMEOUT, \
+    USER_STAFF_CACHE_KEY, USER_STAFF_CACHE_TIMEOUT, \
+    COMPANY_SETTINGS_CACHE_KEY, COMPANY_SETTINGS_CACHE_TIMEOUT, \
+    CATEGORY_LISTS_CACHE_KEY, CATEGORY_LISTS_CACHE_TIMEOUT, \
+    PUBLIC_CHARACTERS_CACHE_KEY, PUBLIC_CHARACTERS_CACHE_TIMEOUT, TOKEN_PACKAGES_CACHE_KEY, \
+    TOKEN_PACKAGES_CACHE_TIMEOUT, SUBSCRIPTION_PLANS_CACHE_KEY, SUBSCRIPTION_PLANS_CACHE_TIMEOUT, \
+    VideoDurationOption, VideoQualityOption, VIDEO_OPTIONS_CACHE_KEY, VIDEO_OPTIONS_CACHE_TIMEOUT, \
+    COMFY_CHECKPOINTS_CACHE_KEY, COMFY_CHECKPOINTS_CACHE_TIMEOUT, PAYMENT_METHODS_CACHE_KEY, \
+    PAYMENT_METHODS_CACHE_TIMEOUT, PAYMENT_RESULT_PAGE_CACHE_KEY, caller_deletes_media_files  # IMPORTAR NUEVO MODELO
 import json
+from collections import defaultdict
+import orjson
+import mimetypes
 import os
+import re
+import asyncio
+import struct
+import functools
+import itertools
+import threading
+import time
 import uuid
 from django.conf import settings
 from asgiref.sync import sync_to_async
-from django.http import JsonResponse, FileResponse, Http404
+from django.http import JsonResponse, FileResponse, HttpResponse, StreamingHttpResponse, Http404
 from django.core.files.base import ContentFile
+from django.core.files import File
+from django.core.files.storage import default_storage
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
 from django.urls import reverse
-from django.db.models import Prefetch, Q, Count, Max
+from django.core import signing
+from django.utils.http import urlencode, http_date
+from urllib.parse import quote
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.db.models import Prefetch, Q, Count, Max, F, Window, OuterRef, Subquery, Exists
+from django.db.models.functions import RowNumber, Coalesce
 from django.contrib.auth.models import User
 from .services import generate_image_from_character, get_active_comfyui_address, get_comfyui_object_info, \
     analyze_workflow, update_workflow, queue_prompt, get_history, get_image, get_protocols, analyze_workflow_outputs
-from .video_services import generate_video_task  # IMPORTANTE: Importar servicio de video
+from .video_services import generate_video_task, discard_temp_file  # IMPORTANTE: Importar servicio de video
 from PIL import Image as PILImage
 import io
 import httpx
@@ -30,24 +58,134 @@ import random  # IMPORTANTE: Para seleccionar imágenes aleatorias
 from paypal.standard.forms import PayPalPaymentsForm  # IMPORTANTE: Para PayPal
 from django.views.decorators.csrf import csrf_exempt  # IMPORTANTE: Para PayPal
 from datetime import timedelta
-import stripe  # IMPORTANTE: Para Stripe
+from concurrent.futures import ThreadPoolExecutor
 import decimal
+import logging
 from django_ratelimit.decorators import ratelimit  # IMPORTANTE: Para Rate Limiting Seguro
 
+logger = logging.getLogger(__name__)
+
 
 # --- CLASE PERSONALIZADA PARA PAYPAL DINÁMICO ---
 class DynamicPayPalForm(PayPalPaymentsForm):
+    SANDBOX_ENDPOINT = "https://www.sandbox.paypal.com/cgi-bin/webscr"
+    LIVE_ENDPOINT = "https://www.paypal.com/cgi-bin/webscr"
+
     def __init__(self, *args, **kwargs):
         # Extraemos el argumento 'is_sandbox' si existe, por defecto True
         self.is_sandbox = kwargs.pop('is_sandbox', True)
         super().__init__(*args, **kwargs)
 
     def get_endpoint(self):
-        # Sobrescribimos el método para usar nuestra variable local
-        if self.is_sandbox:
-            return "https://www.sandbox.paypal.com/cgi-bin/webscr"
-        else:
-            return "https://www.paypal.com/cgi-bin/webscr"
+        # Sobrescribimos el método para usar nuestra variable local (sin consultar la BD)
+        return self.SANDBOX_ENDPOINT if self.is_sandbox else self.LIVE_ENDPOINT
+
+
+# --- JSON RESPONSE SERIALIZED WITH ORJSON ---
+class OrjsonResponse(HttpResponse):
+    """JsonResponse equivalent for the larger success payloads: orjson serializes straight to bytes in C."""
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(orjson.dumps(data), **kwargs)
+
+
+# --- SHARED PREFETCH FOR CATALOG IMAGES ---
+# Un solo queryset reutilizado por todas las vistas que muestran el catálogo
+CATALOG_IMAGES_QS = CharacterCatalogImage.objects.only('id', 'image', 'order', 'character_id')
+CATALOG_IMAGES_PREFETCH = Prefetch('catalog_images_set', queryset=CATALOG_IMAGES_QS)
+
+
+# --- SIGNED MEDIA URLS ---
+# Media URLs rendered server-side carry an HMAC token bound to the file path, so
+# serve_private_media can authorize them without resolving the session or the owner.
+MEDIA_SIGNING_SALT = 'myapp.private_media'
+SIGNED_MEDIA_MAX_AGE = 300  # seconds (freshly generated results)
+SIGNED_GALLERY_MAX_AGE = 86400  # seconds (gallery / history listings)
+MEDIA_SIGNER = signing.Signer(salt=MEDIA_SIGNING_SALT)
+
+# MEDIA_ROOT no cambia en runtime: se resuelve una sola vez al cargar el módulo
+MEDIA_ROOT_ABS = os.path.abspath(settings.MEDIA_ROOT) + os.sep
+PRIVATE_MEDIA_BLOCK_SIZE = 1 << 20  # 1 MiB
+PRIVATE_MEDIA_CACHE_MAX_AGE = 86400  # seconds
+BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+@functools.lru_cache(maxsize=1)
+def get_private_media_prefix():
+    """URL prefix of serve_private_media, resolved once instead of a reverse() per listed file."""
+    return reverse('serve_private_media', kwargs={'path': '_'})[:-1]
+
+
+def build_signed_media_url(path, user_id, max_age=SIGNED_MEDIA_MAX_AGE):
+    """
+    Returns the serve_private_media URL for `path` with a signed `sig` query param.
+    The expiry is rounded to a max_age window so the URL stays stable (and browser-cacheable)
+    within it; the token is valid for at least max_age seconds.
+    """
+    expires = (int(time.time()) // max_age + 2) * max_age
+    token = MEDIA_SIGNER.sign_object({'p': path, 'u': user_id, 'e': expires})
+    # Same quoting reverse() applies to the <path:path> segment
+    quoted_path = quote(path, safe="/~:@!$&'()*+,;=")
+    return f"{get_private_media_prefix()}{quoted_path}?{urlencode({'sig': token})}"
+
+
+def has_valid_media_signature(request, normalized_path):
+    sig = request.GET.get('sig')
+    if not sig:
+        return False
+    try:
+        payload = MEDIA_SIGNER.unsign_object(sig)
+    except signing.BadSignature:
+        return False
+    if payload.get('e', 0) < time.time():
+        return False
+    return os.path.normpath(payload.get('p', '')) == normalized_path
+
+
+def parse_byte_range(range_header, size):
+    """
+    Returns the inclusive (start, end) of a single 'bytes=' range, or None if there is no usable
+    Range header (multi-range, other units and invalid specs like 'bytes=500-100' are served as
+    the full file, as RFC 7233 asks). Raises ValueError if the range can't be satisfied.
+    """
+    if not range_header:
+        return None
+    match = BYTE_RANGE_RE.match(range_header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("Unsatisfiable range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        # Syntactically invalid (last-byte-pos < first-byte-pos): ignore the header
+        return None
+    if start >= size:
+        raise ValueError("Unsatisfiable range")
+    end = min(int(last), size - 1) if last else size - 1
+    return start, end
+
+
+def iter_file_range(file_obj, start, length):
+    """Yields `length` bytes from `start` in PRIVATE_MEDIA_BLOCK_SIZE blocks, closing the file at the end."""
+    try:
+        file_obj.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = file_obj.read(min(PRIVATE_MEDIA_BLOCK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        file_obj.close()
 
 
 # --- SECURE MEDIA SERVING VIEW ---
@@ -55,9 +193,10 @@ def serve_private_media(request, path):
     """
     Serves files from the 'user_images' folder.
     Allows access if:
-    1. The requesting user is the owner.
-    2. The requesting user is staff.
-    3. The image owner is staff (public/official image).
+    1. The URL carries a valid, unexpired signature for this path.
+    2. The requesting user is the owner.
+    3. The requesting user is staff.
+    4. The image owner is staff (public/official image).
     """
     # --- SECURITY FIX (Path Traversal) ---
     # Normalize the path to remove '..' and redundancies
@@ -67,56 +206,113 @@ def serve_private_media(request, path):
     if '..' in normalized_path or normalized_path.startswith(('/', '\\')):
         raise Http404("Invalid file path.")
 
-    file_path = os.path.join(settings.MEDIA_ROOT, normalized_path)
+    file_path = os.path.normpath(os.path.join(MEDIA_ROOT_ABS, normalized_path))
 
     # Double check: ensure the final path is still within MEDIA_ROOT
-    if not os.path.abspath(file_path).startswith(os.path.abspath(settings.MEDIA_ROOT)):
+    if not file_path.startswith(MEDIA_ROOT_ABS):
         raise Http404("Access denied: Path traversal attempt.")
     # ------------------------------------------------
 
-    try:
-        # Use normalized_path instead of raw path
-        parts = normalized_path.split(os.sep)  # Use system separator
-
-        # Robust path handling (Windows/Linux)
-        if len(parts) > 1 and parts[0] == 'user_images':
-            owner_id = int(parts[1])
-        elif len(parts) > 1 and parts[0] == 'user_videos':  # NUEVO: Soporte para videos
-            owner_id = int(parts[1])
-        else:
-            # If not user_images, it could be another public or protected folder
-            # By default, if it doesn't follow the user_images/ID/... pattern, deny access for now
-            # unless it's staff.
-            if request.user.is_staff:
-                owner_id = request.user.id  # Bypass for staff
-            else:
-                raise Http404("Not a user file.")
+    # --- FAST PATH: Signed URL (no session / User lookup) ---
+    has_access = has_valid_media_signature(request, normalized_path)
 
-    except (ValueError, IndexError):
-        raise Http404("Malformed file path.")
+    if not has_access:
+        try:
+            # Use normalized_path instead of raw path
+            parts = normalized_path.split(os.sep)  # Use system separator
+
+            # Robust path handling (Windows/Linux)
+            if len(parts) > 1 and parts[0] == 'user_images':
+                owner_id = int(parts[1])
+            elif len(parts) > 1 and parts[0] == 'user_videos':  # NUEVO: Soporte para videos
+                owner_id = int(parts[1])
+            else:
+                # If not user_images, it could be another public or protected folder
+                # By default, if it doesn't follow the user_images/ID/... pattern, deny access for now
+                # unless it's staff.
+                if request.user.is_staff:
+                    owner_id = request.user.id  # Bypass for staff
+                else:
+                    raise Http404("Not a user file.")
 
-    # Check permissions
-    has_access = False
+        except (ValueError, IndexError):
+            raise Http404("Malformed file path.")
 
-    # 1. If the user is authenticated and is the owner or staff
-    if request.user.is_authenticated:
-        if request.user.id == owner_id or request.user.is_staff:
-            has_access = True
+        # Check permissions
 
-    # 2. If no access yet, check if the image owner is staff (making it public)
-    if not has_access:
-        try:
-            owner = User.objects.get(pk=owner_id)
-            if owner.is_staff:
+        # 1. If the user is authenticated and is the owner or staff
+        if request.user.is_authenticated:
+            if request.user.id == owner_id or request.user.is_staff:
                 has_access = True
-        except User.DoesNotExist:
-            pass
+
+        # 2. If no access yet, check if the image owner is staff (making it public)
+        # Cached per owner: a gallery page requests dozens of files from the same few owners
+        if not has_access:
+            has_access = cache.get_or_set(
+                USER_STAFF_CACHE_KEY.format(pk=owner_id),
+                lambda: bool(User.objects.filter(pk=owner_id).values_list('is_staff', flat=True).first()),
+                USER_STAFF_CACHE_TIMEOUT,
+            )
 
     if has_access:
-        if os.path.exists(file_path):
-            return FileResponse(open(file_path, 'rb'))
-        else:
+        accel_prefix = getattr(settings, 'PRIVATE_MEDIA_ACCEL_PREFIX', '')
+        # Open (or stat) directly and handle the error: no exists() check, no race between check and open
+        file_obj = None
+        try:
+            if accel_prefix:
+                stat = os.stat(file_path)
+            else:
+                file_obj = open(file_path, 'rb')
+                stat = os.fstat(file_obj.fileno())
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
             raise Http404("File does not exist.")
+
+        # --- CONDITIONAL GET: 304 if the browser already has this version ---
+        etag = f'"{int(stat.st_mtime)}-{stat.st_size}"'
+        last_modified = int(stat.st_mtime)
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            if file_obj:
+                file_obj.close()
+            return not_modified
+
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        if accel_prefix:
+            # --- ZERO-COPY: nginx entrega el archivo (sendfile), Django solo autoriza ---
+            # (nginx also answers Range requests itself)
+            response = HttpResponse(content_type=content_type)
+            # nginx decodes the internal URI: percent-encode names with spaces, non-ASCII, '%' or '?'
+            response['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + quote(
+                normalized_path.replace(os.sep, '/'), safe='/')
+        else:
+            # --- RANGE REQUESTS: video seeking / resumed downloads only send the requested bytes ---
+            byte_range = None
+            if_range = request.headers.get('If-Range')
+            if not if_range or if_range == etag:
+                try:
+                    byte_range = parse_byte_range(request.headers.get('Range'), stat.st_size)
+                except ValueError:
+                    file_obj.close()
+                    response = HttpResponse(status=416)
+                    response['Content-Range'] = f'bytes */{stat.st_size}'
+                    return response
+
+            if byte_range:
+                start, end = byte_range
+                response = StreamingHttpResponse(
+                    iter_file_range(file_obj, start, end - start + 1), status=206, content_type=content_type)
+                response['Content-Length'] = str(end - start + 1)
+                response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            else:
+                response = FileResponse(file_obj)
+                # Under ASGI each block is one thread hop: read in large blocks, not the 4 KiB default
+                response.block_size = PRIVATE_MEDIA_BLOCK_SIZE
+            response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        # Generated files never change in place: let the browser reuse them without revalidating
+        patch_cache_control(response, private=True, max_age=PRIVATE_MEDIA_CACHE_MAX_AGE)
+        return response
     else:
         raise Http404("Access denied.")
 
@@ -125,37 +321,257 @@ def serve_private_media(request, path):
 @sync_to_async
 def get_characters_with_images(user=None):
     # Base query: Active characters -> ORDERED BY SUBCATEGORY NAME, THEN CHARACTER NAME
+    # Only the columns the selector lists and the workspace read: no JSON config, and the templates use
+    # category_id / subcategory_id, so no category/subcategory objects are joined and built
     qs = Character.objects.filter(is_active=True).order_by('subcategory__name', 'name').prefetch_related(
-        'catalog_images_set').select_related('category', 'subcategory')
+        CATALOG_IMAGES_PREFETCH).only(
+        'id', 'name', 'description', 'is_private', 'category_id', 'subcategory_id', 'base_workflow_id',
+        'default_width', 'default_height', 'default_seed')
 
     if user and user.is_authenticated:
         # If user is logged in, show public OR private ones they have unlocked
-        # Subquery for unlocked private characters
-        unlocked_ids = UserCharacterAccess.objects.filter(user=user).values_list('character_id', flat=True)
+        # Unlocked private characters as a correlated EXISTS in the same statement: a semi-join probing
+        # the (user, character) unique index, no ID round trip and no IN-list
+        unlocked = UserCharacterAccess.objects.filter(user=user, character=OuterRef('pk'))
 
         # Filter: (Public) OR (Private AND Unlocked)
-        qs = qs.filter(Q(is_private=False) | Q(id__in=unlocked_ids))
+        qs = qs.filter(Q(is_private=False) | Exists(unlocked))
     else:
         # If not logged in, only show public
+        # Same list for every anonymous visitor (crawlers, health checks): served from cache
         qs = qs.filter(is_private=False)
+        return cache.get_or_set(PUBLIC_CHARACTERS_CACHE_KEY, lambda: list(qs), PUBLIC_CHARACTERS_CACHE_TIMEOUT)
 
     return list(qs.all())
 
 
 # --- FUNCTION TO GET COMPANY SETTINGS ---
-@sync_to_async
-def get_company_settings():
-    # Prefetch to get hero carousel images and showcase items
-    return CompanySettings.objects.prefetch_related('hero_images', 'showcase_items').last()  # CAMBIO: .last()
+def cached_company_settings():
+    # Prefetch to get showcase items (hero carousel items are cached separately)
+    # Read-mostly row: cached, invalidated by signals on CompanySettings / ShowcaseItem
+    return cache.get_or_set(
+        COMPANY_SETTINGS_CACHE_KEY,
+        lambda: CompanySettings.objects.prefetch_related('showcase_items').last(),  # CAMBIO: .last()
+        COMPANY_SETTINGS_CACHE_TIMEOUT
+    )
+
+
+get_company_settings = sync_to_async(cached_company_settings)
+
+
+def cached_payment_result_page(page):
+    # Static confirmation pages (PayPal / Stripe return here): the HTML only depends on the
+    # company branding, so it is rendered once and invalidated with the CompanySettings cache
+    html = cache.get_or_set(
+        PAYMENT_RESULT_PAGE_CACHE_KEY.format(page),
+        lambda: render_to_string(f'myapp/{page}.html', {'company': cached_company_settings()}),
+        COMPANY_SETTINGS_CACHE_TIMEOUT
+    )
+    return HttpResponse(html)
+
+
+# --- FUNCTION TO GET CATEGORIES AND SUBCATEGORIES (ORDERED BY NAME) ---
+def cached_category_lists():
+    # Admin-tuned, read-mostly: cached, invalidated by signals on CharacterCategory / CharacterSubCategory
+    return cache.get_or_set(
+        CATEGORY_LISTS_CACHE_KEY,
+        lambda: (list(CharacterCategory.objects.all().order_by('name')),
+                 list(CharacterSubCategory.objects.all().order_by('name'))),
+        CATEGORY_LISTS_CACHE_TIMEOUT
+    )
+
+
+get_category_lists = sync_to_async(cached_category_lists)
+
+
+# --- VIDEO OPTIONS (active durations and qualities of the VideoConfiguration singleton) ---
+def cached_video_options():
+    # Static admin-managed options: cached, invalidated by the option signals in models.py.
+    # The singleton is always pk=1, so no VideoConfiguration.load() round trip is needed to filter.
+    return cache.get_or_set(
+        VIDEO_OPTIONS_CACHE_KEY,
+        lambda: (list(VideoDurationOption.objects.filter(config_id=1, is_active=True).order_by('duration')),
+                 list(VideoQualityOption.objects.filter(config_id=1, is_active=True))),
+        VIDEO_OPTIONS_CACHE_TIMEOUT
+    )
+
+
+# --- FUNCTIONS TO GET ACTIVE TOKEN PACKAGES / SUBSCRIPTION PLANS ---
+def cached_token_packages():
+    # Invalidated by the TokenPackage signals in models.py
+    return cache.get_or_set(
+        TOKEN_PACKAGES_CACHE_KEY,
+        lambda: list(TokenPackage.objects.filter(is_active=True)),
+        TOKEN_PACKAGES_CACHE_TIMEOUT
+    )
+
+
+def cached_subscription_plans():
+    # Ordered by price; invalidated by the SubscriptionPlan signals in models.py
+    return cache.get_or_set(
+        SUBSCRIPTION_PLANS_CACHE_KEY,
+        lambda: list(SubscriptionPlan.objects.filter(is_active=True).order_by('price')),
+        SUBSCRIPTION_PLANS_CACHE_TIMEOUT
+    )
+
+
+def get_subscription_plan_or_404(plan_id):
+    # Active plans are already in the cached list: no query; anything else falls back to the DB as before
+    for plan in cached_subscription_plans():
+        if plan.id == plan_id:
+            return plan
+    return get_object_or_404(SubscriptionPlan, id=plan_id)
+
+
+def cached_active_payment_methods():
+    # Config keys of the enabled methods ('stripe', 'paypal', 'crypto'...); invalidated by the PaymentMethod signals.
+    # frozenset: views and templates only test membership / emptiness, and the shared value stays immutable
+    return cache.get_or_set(
+        PAYMENT_METHODS_CACHE_KEY,
+        lambda: frozenset(PaymentMethod.objects.filter(is_active=True).values_list('config_key', flat=True)),
+        PAYMENT_METHODS_CACHE_TIMEOUT
+    )
+
+
+# --- HELPER: PARALLEL FILE DELETION ---
+STORAGE_DELETE_WORKERS = 16
+
+
+def delete_storage_files(names):
+    """Deletes the given storage names concurrently, skipping empty values."""
+    names = [name for name in names if name]
+    if not names:
+        return
+    with ThreadPoolExecutor(max_workers=min(STORAGE_DELETE_WORKERS, len(names))) as executor:
+        list(executor.map(default_storage.delete, names))
+
+
+def delete_generated_media(images, videos=None):
+    """
+    Deletes the rows of CharacterImage / GeneratedVideo querysets, then all their files (media, thumbnails,
+    workflow JSON) once each, in parallel. The post_delete receivers are told to skip the files, so this is
+    the only deleter; since the rows are gone first, a failed storage call leaves an orphan file, never a
+    row pointing at a missing file. Returns the number of CharacterImage rows deleted.
+    """
+    file_names = []
+    for image, workflow in images.values_list('image', 'generation_workflow'):
+        file_names.extend((image, workflow))
+    if videos is not None:
+        for video_file, thumbnail, workflow in videos.values_list('video_file', 'thumbnail', 'generation_workflow'):
+            file_names.extend((video_file, thumbnail, workflow))
+
+    with caller_deletes_media_files():
+        _, deleted_per_model = images.delete()
+        if videos is not None:
+            videos.delete()
+    delete_storage_files(file_names)
+    return deleted_per_model.get(CharacterImage._meta.label, 0)
+
+
+# --- HELPER: RANDOM SAMPLE OVER AN ITERATOR ---
+def reservoir_sample(iterable, k):
+    """Picks k items uniformly at random in one pass (Algorithm R), keeping only k in memory."""
+    sample = []
+    for i, item in enumerate(iterable):
+        if i < k:
+            sample.append(item)
+        else:
+            j = random.randint(0, i)
+            if j < k:
+                sample[j] = item
+    return sample
+
+
+# --- HELPER: WORKFLOW CAPABILITIES (CACHED) ---
+WORKFLOW_CAPS_CACHE_TIMEOUT = 3600
+
+
+def get_workflow_capabilities(workflow):
+    """
+    Returns analyze_workflow_outputs() for the workflow's JSON file.
+    Workflow has no updated_at, so the key includes the file's mtime/size: re-uploading it invalidates the entry.
+    Only the small capabilities dict is cached, never the workflow JSON.
+    """
+    path = workflow.json_file.path
+    stat = os.stat(path)
+    cache_key = f"wf_caps_{workflow.id}_{stat.st_mtime_ns}_{stat.st_size}"
+
+    def compute():
+        with open(path, 'r', encoding='utf-8') as f:
+            return analyze_workflow_outputs(json.load(f))
+
+    return dict(cache.get_or_set(cache_key, compute, WORKFLOW_CAPS_CACHE_TIMEOUT))
+
+
+# --- HELPER: IMAGE DIMENSIONS WITHOUT DECODING ---
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def get_image_dimensions(img_bytes):
+    """
+    Returns (width, height) for generated image bytes, or (0, 0) if unreadable (model default).
+    ComfyUI outputs PNG, whose IHDR chunk stores the size at bytes 16..24, so PIL is only a fallback.
+    """
+    if img_bytes[:8] == PNG_SIGNATURE and img_bytes[12:16] == b'IHDR':
+        return struct.unpack('>II', img_bytes[16:24])
+    try:
+        with PILImage.open(io.BytesIO(img_bytes)) as pil_img:
+            return pil_img.size
+    except Exception:
+        return 0, 0
+
+
+# --- HELPER: GENERATION RATE LIMIT (CACHE) ---
+GENERATION_COOLDOWN_SECONDS = 10
+
+
+def acquire_generation_slot(kind, user_id):
+    """
+    Atomically takes the generation lock for this user (cache.add = SET NX).
+    Returns 0 if the lock was acquired, otherwise the seconds left to wait.
+    """
+    cache_key = f"gen_limit_{kind}_{user_id}"
+    expires_at = time.time() + GENERATION_COOLDOWN_SECONDS
+    if cache.add(cache_key, expires_at, timeout=GENERATION_COOLDOWN_SECONDS):
+        return 0
+
+    # The lock stores its own expiry, so we don't depend on backend-specific ttl()
+    current_expiry = cache.get(cache_key) or expires_at
+    return max(1, int(current_expiry - time.time() + 0.999))
+
+
+# --- HELPER: COMFYUI CONCURRENCY CAP ---
+# The GPU serializes prompts anyway: extra requests wait here instead of each holding a websocket open.
+# threading (not asyncio) semaphore: under WSGI every async view runs in its own thread and event loop,
+# and an asyncio.Semaphore can only be used from the loop it was first bound to.
+GENERATION_SLOTS = threading.BoundedSemaphore(getattr(settings, 'COMFY_MAX_CONCURRENCY', 3))
+GENERATION_SLOT_POLL_SECONDS = 0.25
+# Upper bound for one generation (wait for a slot and queue wait on the GPU included)
+GENERATION_TIMEOUT_SECONDS = getattr(settings, 'COMFY_GENERATION_TIMEOUT', 600)
+
 
+async def run_with_generation_slot(make_coro):
+    """
+    Waits for a free generation slot, then awaits make_coro().
+    Non-blocking acquire + sleep keeps the wait cancellable, so the caller's wait_for bounds it too.
+    """
+    while not GENERATION_SLOTS.acquire(blocking=False):
+        await asyncio.sleep(GENERATION_SLOT_POLL_SECONDS)
+    try:
+        return await make_coro()
+    finally:
+        GENERATION_SLOTS.release()
 
-# --- HELPER FUNCTION TO GET USER SAFELY ---
+
+# --- HELPER: TOKENS LEFT (ONE HOP) ---
 @sync_to_async
-def get_user_from_request(request):
-    user = request.user
-    if user.is_authenticated:
-        pass
-    return user
+def get_tokens_left(user):
+    """
+    Loads the user's ClientProfile (creating the default one if missing), applies the periodic
+    reset and returns the remaining tokens.
+    """
+    profile, _ = ClientProfile.objects.get_or_create(user=user)
+    return profile.check_reset_and_get_tokens_remaining()
 
 
 # --- HELPER: CHECK USER PERMISSIONS (UPDATED) ---
@@ -164,6 +580,10 @@ def get_user_permissions(user):
     """
     Returns a dict of permissions based on subscription status, grants, and global settings.
     """
+    # If user is staff, they can do everything
+    if user.is_staff:
+        return {'can_upscale': True, 'can_facedetail': True, 'can_eyedetailer': True}
+
     settings = TokenSettings.load()
 
     # Default: Assume Free Tier (Base Plan)
@@ -173,145 +593,121 @@ def get_user_permissions(user):
         'can_eyedetailer': settings.allow_eye_detail_free,
     }
 
-    # If user is staff, they can do everything
-    if user.is_staff:
-        return {'can_upscale': True, 'can_facedetail': True, 'can_eyedetailer': True}
-
-    # 1. Check Subscription (Highest Priority)
-    try:
-        sub = user.subscription
-        if sub.status == 'ACTIVE' and sub.plan:
-            perms['can_upscale'] = perms['can_upscale'] or sub.plan.allow_upscale
-            perms['can_facedetail'] = perms['can_facedetail'] or sub.plan.allow_face_detail
-            perms['can_eyedetailer'] = perms['can_eyedetailer'] or sub.plan.allow_eye_detail
-    except UserSubscription.DoesNotExist:
-        pass
+    # 1. Check Subscription (Highest Priority) - subscription + plan in one query
+    sub = UserSubscription.objects.select_related('plan').filter(user=user, status='ACTIVE').first()
+    if sub and sub.plan:
+        perms['can_upscale'] = perms['can_upscale'] or sub.plan.allow_upscale
+        perms['can_facedetail'] = perms['can_facedetail'] or sub.plan.allow_face_detail
+        perms['can_eyedetailer'] = perms['can_eyedetailer'] or sub.plan.allow_eye_detail
 
-    # 2. Check Active Grants (Becas) - Additive Permissions
+    # 2. Check Active Grants (Becas) - Additive Permissions, OR-reduced in SQL (one aggregate row)
     now = timezone.now()
-    active_grants = UserPremiumGrant.objects.filter(user=user, expires_at__gt=now)
-
-    for grant in active_grants:
-        if grant.grant_upscale: perms['can_upscale'] = True
-        if grant.grant_face_detail: perms['can_facedetail'] = True
-        if grant.grant_eye_detail: perms['can_eyedetailer'] = True
+    grants = UserPremiumGrant.objects.filter(user=user, expires_at__gt=now).aggregate(
+        upscale=Count('id', filter=Q(grant_upscale=True)),
+        face_detail=Count('id', filter=Q(grant_face_detail=True)),
+        eye_detail=Count('id', filter=Q(grant_eye_detail=True)),
+    )
+    if grants['upscale']: perms['can_upscale'] = True
+    if grants['face_detail']: perms['can_facedetail'] = True
+    if grants['eye_detail']: perms['can_eyedetailer'] = True
 
     return perms
 
 
 # --- PROFILE VIEW ---
 async def profile_view(request):
-    user = await get_user_from_request(request)
+    user = await request.auser()  # Async-safe user resolution (Django 5+)
     if not user.is_authenticated:
         return redirect('account_login')
 
-    company_settings = await get_company_settings()
+    # Profile numbers (tokens, image count, plan) in ONE row: profile and subscription/plan are LEFT JOINs,
+    # the image total a correlated COUNT subquery (TokenSettings comes from cache)
+    @sync_to_async
+    def get_profile_stats(u):
+        image_count = CharacterImage.objects.filter(user=OuterRef('pk')).order_by().values('user').annotate(
+            total=Count('id')).values('total')
+        row = User.objects.filter(pk=u.pk).annotate(
+            total_images=Coalesce(Subquery(image_count), 0)
+        ).values(
+            'total_images', 'clientprofile__id', 'clientprofile__tokens_used', 'clientprofile__bonus_tokens',
+            'subscription__status', 'subscription__plan__name'
+        ).first()
 
-    # Get profile data (tokens, etc.)
-    try:
-        profile = await sync_to_async(lambda: user.clientprofile)()
-        tokens = await profile.get_tokens_remaining_async()
-    except ClientProfile.DoesNotExist:
         tokens = 0
-
-    # Get stats (e.g., total images generated)
-    total_images = await sync_to_async(CharacterImage.objects.filter(user=user).count)()
-
-    # --- NEW: Check Social Accounts (Google) ---
-    # Obtenemos TODAS las cuentas de Google ordenadas por last_login (la más reciente primero)
-    google_accounts = await sync_to_async(list)(
-        SocialAccount.objects.filter(user=user, provider='google').order_by('-last_login')
+        if row['clientprofile__id'] is not None:
+            # Formula: (Base + Bonus) - Used (same as ClientProfile.tokens_remaining)
+            tokens = (TokenSettings.load().default_token_allowance + row['clientprofile__bonus_tokens']
+                      - row['clientprofile__tokens_used'])
+
+        # --- LOGICA DE PLAN DE SUSCRIPCIÓN ---
+        if row['subscription__status'] == 'ACTIVE' and row['subscription__plan__name']:
+            plan = (row['subscription__plan__name'], True)
+        else:
+            plan = ("Free Plan", False)
+        return tokens, row['total_images'], plan
+
+    # Independent lookups, fetched together
+    company_settings, (tokens, total_images, (plan_name, is_subscribed)), google_accounts = await asyncio.gather(
+        get_company_settings(),
+        get_profile_stats(user),
+        # --- NEW: Check Social Accounts (Google) ---
+        # Obtenemos TODAS las cuentas de Google ordenadas por last_login (la más reciente primero)
+        sync_to_async(list)(SocialAccount.objects.filter(user=user, provider='google').order_by('-last_login'))
     )
 
     active_google_account = None
 
     # --- LOGICA DE SUSTITUCIÓN DE CUENTA ---
-    if google_accounts:
-        latest_account = google_accounts[0]  # La que acabamos de conectar/usar
-        active_google_account = latest_account
-
-        # 1. Actualizar email del usuario si es diferente
-        google_email = latest_account.extra_data.get('email')
-        if google_email and google_email != user.email:
-            # Guardamos el email antiguo para borrarlo de Allauth después
-            old_email = user.email
-
-            user.email = google_email
-
-            # --- NUEVO: Actualizar Username Automáticamente ---
-            base_username = google_email.split('@')[0]
-            new_username = base_username
-
-            @sync_to_async
-            def check_username_exists(uname):
-                return User.objects.filter(username=uname).exclude(pk=user.pk).exists()
-
-            counter = 1
-            while await check_username_exists(new_username):
-                new_username = f"{base_username}{counter}"
-                counter += 1
-
-            user.username = new_username
-            # --------------------------------------------------
-
-            await sync_to_async(user.save)()
-
-            # --- LIMPIEZA PROFUNDA DE EMAILS (ALLAUTH) ---
-            # Borramos el email antiguo de la tabla de EmailAddress para liberar la cuenta
-            if old_email:
-                @sync_to_async
-                def clean_old_email_address(email_to_remove):
-                    EmailAddress.objects.filter(email=email_to_remove).delete()
-
-                await clean_old_email_address(old_email)
+    # Email swap, Allauth cleanup and stale-account removal in one hop and one transaction
+    @sync_to_async
+    def sync_google_account(user_obj, keep_account_id, new_email):
+        with transaction.atomic():
+            if new_email:
+                # Guardamos el email antiguo para borrarlo de Allauth después
+                old_email = user_obj.email
+                user_obj.email = new_email
+
+                # --- NUEVO: Actualizar Username Automáticamente ---
+                base_username = new_email.split('@')[0]
+
+                # One query for every taken username with this prefix, then pick the first free suffix
+                taken = set(User.objects.filter(username__startswith=base_username).exclude(pk=user_obj.pk)
+                            .values_list('username', flat=True))
+                new_username = base_username
+                counter = 1
+                while new_username in taken:
+                    new_username = f"{base_username}{counter}"
+                    counter += 1
+
+                user_obj.username = new_username
+                user_obj.save()
 
-            # Creamos/Actualizamos el nuevo email en EmailAddress como verificado y primario
-            @sync_to_async
-            def update_new_email_address(user_obj, new_email):
-                # Borramos cualquier registro previo de este nuevo email (por si acaso)
-                EmailAddress.objects.filter(email=new_email).delete()
-                # Creamos el nuevo registro limpio
-                EmailAddress.objects.create(
+                # --- LIMPIEZA PROFUNDA DE EMAILS (ALLAUTH) ---
+                # Borramos el email antiguo (para liberar la cuenta) y cualquier registro previo
+                # del nuevo email que no sea ya el de este usuario, en un solo DELETE
+                EmailAddress.objects.filter(email__in=[e for e in (old_email, new_email) if e]).exclude(
+                    user=user_obj, email=new_email).delete()
+                # Creamos/Actualizamos el nuevo email como verificado y primario
+                EmailAddress.objects.update_or_create(
                     user=user_obj,
                     email=new_email,
-                    verified=True,
-                    primary=True
+                    defaults={'verified': True, 'primary': True}
                 )
 
-            await update_new_email_address(user, google_email)
-            # ---------------------------------------------
-
-        # 2. Eliminar cuentas antiguas (si hay más de una)
-        if len(google_accounts) > 1:
-            # Definimos una función síncrona para borrar
-            @sync_to_async
-            def delete_old_accounts(accounts_list, keep_id):
-                for acc in accounts_list:
-                    if acc.id != keep_id:
-                        acc.delete()
-
-            # Ejecutamos el borrado de las antiguas
-            await delete_old_accounts(google_accounts, latest_account.id)
+            # Eliminar cuentas antiguas (si hay más de una) con un solo DELETE
+            SocialAccount.objects.filter(user=user_obj, provider='google').exclude(id=keep_account_id).delete()
 
-    # --- LOGICA DE PLAN DE SUSCRIPCIÓN ---
-    plan_name = "Free Plan"
-    is_subscribed = False
-    try:
-        # Accedemos a la suscripción (OneToOne) de forma segura en async
-        @sync_to_async
-        def get_subscription_info(u):
-            try:
-                sub = u.subscription
-                if sub.status == 'ACTIVE' and sub.plan:
-                    return sub.plan.name, True
-            except UserSubscription.DoesNotExist:
-                pass
-            return "Free Plan", False
+    if google_accounts:
+        latest_account = google_accounts[0]  # La que acabamos de conectar/usar
+        active_google_account = latest_account
 
-        plan_name, is_subscribed = await get_subscription_info(user)
+        # 1. Actualizar email del usuario si es diferente
+        google_email = latest_account.extra_data.get('email')
+        email_changed = bool(google_email) and google_email != user.email
 
-    except Exception:
-        pass
+        # 2. Steady state (same email, a single account): nothing to write
+        if email_changed or len(google_accounts) > 1:
+            await sync_google_account(user, latest_account.id, google_email if email_changed else None)
 
     context = {
         'company': company_settings,
@@ -322,12 +718,12 @@ async def profile_view(request):
         'plan_name': plan_name,  # NUEVO
         'is_subscribed': is_subscribed  # NUEVO
     }
-    return await sync_to_async(render)(request, 'myapp/profile.html', context)
+    return TemplateResponse(request, 'myapp/profile.html', context)
 
 
 # --- UPDATE USERNAME VIEW ---
 async def update_username_view(request):
-    user = await get_user_from_request(request)
+    user = await request.auser()
     if not user.is_authenticated:
         return JsonResponse({'status': 'error', 'message': 'Unauthorized'}, status=401)
 
@@ -365,32 +761,30 @@ async def update_username_view(request):
 
 
 # --- GALLERY VIEW ---
-async def gallery_view(request):
-    user = await get_user_from_request(request)
-    if not user.is_authenticated:
-        return redirect('account_login')
-
-    company_settings = await get_company_settings()
+GALLERY_CHUNK_SIZE = 500
+GALLERY_PAGE_SIZE = 50  # images embedded per folder / returned per "load more" page
 
-    # Get all images generated by the user
-    user_images = await sync_to_async(list)(
-        CharacterImage.objects.filter(user=user).select_related('character', 'character__category',
-                                                                'character__subcategory').order_by('-id')
-    )
-
-    # --- NUEVO: Get all videos generated by the user ---
-    user_videos = await sync_to_async(list)(
-        GeneratedVideo.objects.filter(user=user).select_related('character').order_by('-created_at')
-    )
 
-    # --- NEW: Get all categories and subcategories ORDERED BY NAME ---
-    all_categories = await sync_to_async(list)(CharacterCategory.objects.all().order_by('name'))
-    all_subcategories = await sync_to_async(list)(CharacterSubCategory.objects.all().order_by('name'))
-
-    # Group by character
+@sync_to_async
+def build_user_gallery(user):
+    """
+    Groups the user's images and videos by character into (public_gallery, private_gallery).
+    Each Character is loaded once with in_bulk instead of being joined onto every row.
+    Folder totals come from one GROUP BY, and only the newest GALLERY_PAGE_SIZE image rows of each
+    folder leave the database (window function); 'next_cursor' is the id the next page starts before
+    (see get_gallery_image_page).
+    """
     public_gallery = {}
     private_gallery = {}
 
+    # Every character the user has media for, loaded once
+    user_images = CharacterImage.objects.filter(user=user)
+    user_videos = GeneratedVideo.objects.filter(user=user)
+    # Only the columns the gallery renders (the filters use the raw category/subcategory ids)
+    characters = Character.objects.filter(
+        Q(id__in=user_images.values('character_id')) | Q(id__in=user_videos.values('character_id'))
+    ).only('id', 'name', 'is_private', 'category_id', 'subcategory_id').in_bulk()
+
     # Helper para inicializar estructura
     def get_or_create_char_entry(target_dict, char):
         if char.id not in target_dict:
@@ -399,39 +793,115 @@ async def gallery_view(request):
                 'images': [],
                 'videos': [],  # NUEVO
                 'count': 0,
-                'latest_image': None
+                'latest_image_url': None,
+                'next_cursor': None
             }
         return target_dict[char.id]
 
-    # Procesar Imágenes
-    for img in user_images:
+    # Totals per folder: (private?, character) <- GROUP BY character, hidden flag
+    image_counts = {}
+    count_rows = user_images.order_by().values('character_id', 'is_hidden_from_admin').annotate(
+        total=Count('id')).values_list('character_id', 'is_hidden_from_admin', 'total')
+    for char_id, is_hidden, total in count_rows:
+        key = (characters[char_id].is_private or is_hidden, char_id)
+        image_counts[key] = image_counts.get(key, 0) + total
+
+    # Procesar Imágenes (newest first, at most one page per character + hidden flag)
+    image_storage = CharacterImage._meta.get_field('image').storage
+    image_rows = user_images.annotate(row_number=Window(
+        RowNumber(), partition_by=[F('character_id'), F('is_hidden_from_admin')], order_by=F('id').desc()
+    )).filter(row_number__lte=GALLERY_PAGE_SIZE).order_by('-id').values_list(
+        'id', 'image', 'character_id', 'is_hidden_from_admin')
+    for img_id, img_name, char_id, is_hidden in image_rows.iterator(chunk_size=GALLERY_CHUNK_SIZE):
+        char = characters[char_id]
         # --- CAMBIO: Si está oculta, va a galería privada ---
-        is_private = img.character.is_private or img.is_hidden_from_admin
-        target_dict = private_gallery if is_private else public_gallery
+        is_private_folder = char.is_private or is_hidden
+        target_dict = private_gallery if is_private_folder else public_gallery
+
+        entry = get_or_create_char_entry(target_dict, char)
+        entry['count'] = image_counts[(is_private_folder, char_id)]
 
-        entry = get_or_create_char_entry(target_dict, img.character)
+        # A private folder merges two partitions (hidden or not): keep its newest page only
+        if len(entry['images']) == GALLERY_PAGE_SIZE:
+            continue
 
+        img_url = image_storage.url(img_name)
         entry['images'].append({
-            'id': img.id,
-            'url': img.image.url
+            'id': img_id,
+            'url': img_url
         })
-        entry['count'] += 1
-        if not entry['latest_image']: entry['latest_image'] = img  # Primera imagen es la más reciente
+        if not entry['latest_image_url']: entry['latest_image_url'] = img_url  # Primera imagen es la más reciente
 
-    # Procesar Videos
-    for vid in user_videos:
-        if not vid.character: continue  # Ignorar videos sin personaje (legacy)
+    # The rest of each folder is fetched page by page from the folder view
+    for entry in itertools.chain(public_gallery.values(), private_gallery.values()):
+        if entry['count'] > len(entry['images']):
+            entry['next_cursor'] = entry['images'][-1]['id']
 
-        target_dict = private_gallery if vid.character.is_private else public_gallery
-        entry = get_or_create_char_entry(target_dict, vid.character)
+    # --- NUEVO: Procesar Videos ---
+    for vid in user_videos.order_by('-created_at').iterator(chunk_size=GALLERY_CHUNK_SIZE):
+        if not vid.character_id: continue  # Ignorar videos sin personaje (legacy)
+        char = characters[vid.character_id]
+
+        target_dict = private_gallery if char.is_private else public_gallery
+        entry = get_or_create_char_entry(target_dict, char)
 
         entry['videos'].append({
             'id': vid.id,
-            'url': reverse('serve_private_media', kwargs={'path': vid.video_file.name}),
+            'url': build_signed_media_url(vid.video_file.name, user.id, SIGNED_GALLERY_MAX_AGE),
             'thumbnail': vid.thumbnail.url if vid.thumbnail else None
         })
         # No incrementamos 'count' para no duplicar visualmente, o podríamos hacerlo si queremos un total mixto
 
+    return public_gallery, private_gallery
+
+
+@sync_to_async
+def get_gallery_image_page(user, character_id, private, before=None):
+    """
+    Keyset page of a gallery folder: the next GALLERY_PAGE_SIZE images with id < before, newest first.
+    Returns (images, next_cursor); next_cursor is None on the last page.
+    """
+    visibility = Q(character__is_private=True) | Q(is_hidden_from_admin=True)
+    images_qs = CharacterImage.objects.filter(user=user, character_id=character_id)
+    images_qs = images_qs.filter(visibility) if private else images_qs.exclude(visibility)
+    if before is not None:
+        images_qs = images_qs.filter(id__lt=before)
+
+    # One extra row tells us whether another page exists
+    rows = list(images_qs.order_by('-id').values_list('id', 'image')[:GALLERY_PAGE_SIZE + 1])
+    next_cursor = rows[GALLERY_PAGE_SIZE - 1][0] if len(rows) > GALLERY_PAGE_SIZE else None
+
+    image_storage = CharacterImage._meta.get_field('image').storage
+    images = [{'id': img_id, 'url': image_storage.url(img_name)} for img_id, img_name in rows[:GALLERY_PAGE_SIZE]]
+    return images, next_cursor
+
+
+async def gallery_view(request):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect('account_login')
+
+    # --- NEW: "Load more" pages of a folder (keyset pagination by id) ---
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        try:
+            character_id = int(request.GET.get('character_id', ''))
+            before = int(request.GET['before']) if request.GET.get('before') else None
+        except ValueError:
+            return JsonResponse({'status': 'error', 'message': 'Invalid page parameters'}, status=400)
+
+        private = request.GET.get('private') == '1'
+        images, next_cursor = await get_gallery_image_page(user, character_id, private, before)
+        return OrjsonResponse({'status': 'success', 'images': images, 'next_cursor': next_cursor})
+
+    # Independent lookups, fetched together
+    company_settings, (all_categories, all_subcategories), (public_gallery, private_gallery) = await asyncio.gather(
+        get_company_settings(),
+        # --- NEW: Get all categories and subcategories ORDERED BY NAME (cached) ---
+        get_category_lists(),
+        # Group by character (folder counts + first page of each folder)
+        build_user_gallery(user)
+    )
+
     context = {
         'company': company_settings,
         'public_gallery': list(public_gallery.values()),
@@ -439,12 +909,12 @@ async def gallery_view(request):
         'all_categories': all_categories,  # Pass categories to template
         'all_subcategories': all_subcategories,  # Pass subcategories to template
     }
-    return await sync_to_async(render)(request, 'myapp/gallery.html', context)
+    return TemplateResponse(request, 'myapp/gallery.html', context)
 
 
 # --- VIEW TO DELETE IMAGES ---
 async def delete_images_view(request):
-    user = await get_user_from_request(request)
+    user = await request.auser()
     if not user.is_authenticated:
         return JsonResponse({'status': 'error', 'message': 'Unauthorized'}, status=401)
 
@@ -456,14 +926,8 @@ async def delete_images_view(request):
 
             @sync_to_async
             def perform_delete(ids, user_obj):
-                qs = CharacterImage.objects.filter(id__in=ids, user=user_obj)
-                deleted_count = 0
-                for img in qs:
-                    if img.image:
-                        img.image.delete(save=False)
-                    deleted_count += 1
-                qs.delete()
-                return deleted_count
+                # Rows first, then each image / workflow file once, in parallel
+                return delete_generated_media(CharacterImage.objects.filter(id__in=ids, user=user_obj))
 
             count = await perform_delete(image_ids, user)
             return JsonResponse({'status': 'success', 'deleted_count': count})
@@ -475,7 +939,7 @@ async def delete_images_view(request):
 
 # --- VIEW TO DELETE INDIVIDUAL MESSAGE ---
 async def delete_message_view(request):
-    user = await get_user_from_request(request)
+    user = await request.auser()
     if not user.is_authenticated:
         return JsonResponse({'status': 'error', 'message': 'Unauthorized'}, status=401)
 
@@ -492,19 +956,11 @@ async def delete_message_view(request):
                     if del_imgs:
                         # Delete associated images
                         images = msg.generated_images.all()
-                        for img in images:
-                            if img.image:
-                                img.image.delete(save=False)  # Delete file
-                            img.delete()  # Delete record
-
                         # --- NUEVO: Delete associated videos ---
                         videos = msg.generated_videos.all()
-                        for vid in videos:
-                            if vid.video_file:
-                                vid.video_file.delete(save=False)
-                            if vid.thumbnail:
-                                vid.thumbnail.delete(save=False)
-                            vid.delete()
+
+                        # Delete the rows, then their files once each, in parallel
+                        delete_generated_media(images, videos)
 
                     msg.delete()
                     return True
@@ -526,7 +982,7 @@ async def delete_message_view(request):
 
 # --- VIEW TO CLEAR ENTIRE CHAT HISTORY ---
 async def clear_chat_history_view(request):
-    user = await get_user_from_request(request)
+    user = await request.auser()
     if not user.is_authenticated:
         return JsonResponse({'status': 'error', 'message': 'Unauthorized'}, status=401)
 
@@ -541,22 +997,13 @@ async def clear_chat_history_view(request):
                 msgs = ChatMessage.objects.filter(user=user_obj, character_id=char_id)
 
                 if del_imgs:
-                    # Collect all images from these messages
-                    for msg in msgs:
-                        images = msg.generated_images.all()
-                        for img in images:
-                            if img.image:
-                                img.image.delete(save=False)
-                            img.delete()
+                    # Collect all images from these messages (one query, not one per message)
+                    images = CharacterImage.objects.filter(chat_messages__in=msgs).distinct()
+                    # --- NUEVO: Collect all videos ---
+                    videos = GeneratedVideo.objects.filter(chat_messages__in=msgs).distinct()
 
-                        # --- NUEVO: Collect all videos ---
-                        videos = msg.generated_videos.all()
-                        for vid in videos:
-                            if vid.video_file:
-                                vid.video_file.delete(save=False)
-                            if vid.thumbnail:
-                                vid.thumbnail.delete(save=False)
-                            vid.delete()
+                    # Delete the rows, then their files once each, in parallel
+                    delete_generated_media(images, videos)
 
                 # Delete the messages
                 count, _ = msgs.delete()
@@ -571,29 +1018,49 @@ async def clear_chat_history_view(request):
     return JsonResponse({'status': 'error', 'message': 'Method not allowed'}, status=405)
 
 
+# generation_type -> badge shown in the chat history
+HISTORY_IMAGE_TYPES = {
+    "Gen_UpScaler": "UPSCALER",
+    "Gen_FaceDetailer": "FACEDETAILER",
+    "Gen_EyeDetailer": "EYEDETAILER",
+}
+
+
 # --- WORKSPACE VIEW ---
 async def workspace_view(request):
-    user = await get_user_from_request(request)
+    user = await request.auser()
     if not user.is_authenticated:
         return redirect('account_login')
 
-    company_settings = await get_company_settings()
-
-    # Get all characters for the selection modal (Filtered by user access)
-    all_characters = await get_characters_with_images(user)
-
-    # --- NEW: Get all categories and subcategories ORDERED BY NAME ---
-    all_categories = await sync_to_async(list)(CharacterCategory.objects.all().order_by('name'))
-    all_subcategories = await sync_to_async(list)(CharacterSubCategory.objects.all().order_by('name'))
+    # --- NEW: Get all categories and subcategories ORDERED BY NAME + Video Configuration Options ---
+    @sync_to_async
+    def get_workspace_options():
+        categories, subcategories = cached_category_lists()
+        # Opciones de video (cacheadas): CAMBIO: resolutions -> qualities
+        durations, qualities = cached_video_options()
+        return categories, subcategories, durations, qualities
 
-    # --- NEW: Get Video Configuration Options ---
-    # Usamos el método load() para obtener la configuración global
-    video_config = await sync_to_async(VideoConfiguration.load)()
+    # --- NEW: Get list of recent chats (character ids, most recent first) ---
+    @sync_to_async
+    def get_recent_chat_ids():
+        # One aggregate query: character ids the user has chatted with
+        return list(ChatMessage.objects.filter(user=user).values('character_id').annotate(
+            last_ts=Max('timestamp')).order_by('-last_ts').values_list('character_id', flat=True))
+
+    # Independent lookups, fetched together
+    (company_settings, all_characters, (all_categories, all_subcategories, video_durations, video_qualities),
+     user_permissions, recent_ids) = await asyncio.gather(
+        get_company_settings(),
+        get_characters_with_images(user),  # Filtered by user access
+        get_workspace_options(),
+        get_user_permissions(user),  # --- NEW: Get User Permissions ---
+        get_recent_chat_ids()
+    )
+    logger.debug("Permissions: user=%s staff=%s perms=%s", user.username, user.is_staff, user_permissions)
 
-    # Obtenemos las opciones relacionadas
-    video_durations = await sync_to_async(list)(video_config.durations.filter(is_active=True).order_by('duration'))
-    video_qualities = await sync_to_async(list)(
-        video_config.qualities.filter(is_active=True))  # CAMBIO: resolutions -> qualities
+    # Resolve recent chats against the characters already loaded (active, accessible, catalog images prefetched)
+    characters_by_id = {c.id: c for c in all_characters}
+    recent_chats = [characters_by_id[cid] for cid in recent_ids if cid in characters_by_id]
 
     # Check if a character is selected
     character_id = request.GET.get('character_id')
@@ -604,7 +1071,6 @@ async def workspace_view(request):
     selected_character = None
     chat_history_image = []  # List for IMAGE chat
     chat_history_video = []  # List for VIDEO chat
-    recent_chats = []  # List for the left sidebar
 
     # Default values if no character
     default_width = 1024
@@ -618,75 +1084,27 @@ async def workspace_view(request):
         'can_eyedetailer': False  # NUEVO: Por defecto False
     }
 
-    # --- NEW: Get User Permissions ---
-    user_permissions = await get_user_permissions(user)
-    print(f"DEBUG PERMISSIONS: User={user.username}, Staff={user.is_staff}, Perms={user_permissions}")  # LOG
-
-    # --- NEW: Get list of recent chats WITH IMAGES ---
-    @sync_to_async
-    def get_recent_chats_list():
-        # 1. Get character IDs spoken to, ordered by date
-        recent_ids = list(ChatMessage.objects.filter(user=user)
-                          .values_list('character_id', flat=True)
-                          .order_by('-timestamp'))
-
-        # 2. Remove duplicates while maintaining order
-        seen = set()
-        unique_ids = [x for x in recent_ids if not (x in seen or seen.add(x))]
-
-        if not unique_ids:
-            return []
-
-        # 3. Get the full Character objects (with catalog images)
-        # --- NEW: Filter by is_active=True ---
-        chars_qs = Character.objects.filter(id__in=unique_ids, is_active=True).prefetch_related('catalog_images_set')
-        chars_dict = {c.id: c for c in chars_qs}
-
-        # 4. Rebuild the list in the correct order
-        ordered_chars = []
-        for cid in unique_ids:
-            if cid in chars_dict:
-                ordered_chars.append(chars_dict[cid])
-
-        return ordered_chars
-
-    recent_chats = await get_recent_chats_list()
-
     # --- FIXED: Random Preview Images for Welcome Screen ---
     random_preview_images = []
     if not character_id:
-        # 1. Get all active characters with their catalog images prefetched
-        # --- CHANGE: Use the filtered list we already got ---
-        all_active_chars = all_characters
-
-        # 2. Collect all catalog images into a single list
-        all_catalog_images = []
-        for char in all_active_chars:
-            all_catalog_images.extend(list(char.catalog_images_set.all()))
-
-        # 3. Shuffle and pick 2 if available
-        if len(all_catalog_images) >= 2:
-            random_images = random.sample(all_catalog_images, 2)
-        else:
-            random_images = all_catalog_images  # Take all if less than 2
+        # 1. Catalog images are already prefetched on the filtered character list: no extra query
+        # (a DB-side ORDER BY RANDOM() would add a query and sort the whole table)
+        # 2 + 3. Pick 2 at random in a single pass (take all if less than 2), without a flattened list
+        random_images = reservoir_sample(itertools.chain.from_iterable(
+            char.catalog_images_set.all() for char in all_characters), 2)
 
         # 4. Format for the template
         for img in random_images:
             random_preview_images.append({
-                'character_id': img.character.id,  # An image object should have a character attribute
+                'character_id': img.character_id,
                 'image_url': img.image.url
             })
 
     # --- SHOWCASE ITEMS (NEW for Workspace) ---
     showcase_items = []
     if company_settings:
-        @sync_to_async
-        def get_showcase_items():
-            # Prefetching was done in get_company_settings, so this should be efficient
-            return list(company_settings.showcase_items.all())
-        
-        s_items = await get_showcase_items()
-        for item in s_items:
+        # Prefetched (and cached) with the company settings: plain iteration, no query and no threadpool hop
+        for item in company_settings.showcase_items.all():
             showcase_items.append({
                 'image_url': item.image.url,
                 'prompt': item.prompt
@@ -694,37 +1112,27 @@ async def workspace_view(request):
 
     if character_id:
         try:
-            # Search in the already loaded list to avoid another query
-            selected_character = next((c for c in all_characters if str(c.id) == str(character_id)), None)
+            # Search in the already loaded list to avoid another query (O(1) lookup by id)
+            try:
+                selected_character = characters_by_id.get(int(character_id))
+            except ValueError:
+                selected_character = None
 
             # --- NEW: Analyze Workflow to determine capabilities ---
             if selected_character:
                 # --- NEW: Extract default dimensions and seed from character's JSON ---
-                if selected_character.character_config:
-                    try:
-                        config = json.loads(selected_character.character_config)
-                        if 'width' in config: default_width = int(config['width'])
-                        if 'height' in config: default_height = int(config['height'])
-
-                        # Seed logic:
-                        if config.get('seed_behavior') == 'fixed' and 'seed' in config:
-                            default_seed = int(config['seed'])
-                        else:
-                            default_seed = -1
-
-                    except (json.JSONDecodeError, ValueError):
-                        pass
-
-                @sync_to_async
-                def get_workflow_json():
-                    with open(selected_character.base_workflow.json_file.path, 'r', encoding='utf-8') as f:
-                        return json.load(f)
+                # Denormalized on Character.save(), no JSON parsing per request
+                default_width = selected_character.default_width
+                default_height = selected_character.default_height
+                default_seed = selected_character.default_seed
 
                 try:
-                    wf_json = await get_workflow_json()
-                    # analyze_workflow_outputs needs the node structure, so we use the base.
-                    workflow_capabilities = analyze_workflow_outputs(wf_json)
-                    print(f"DEBUG WORKFLOW (RAW): {workflow_capabilities}")  # LOG
+                    # analyze_workflow_outputs needs the node structure, so we use the base (cached per file version).
+                    # Only the file reference is needed: skip the active_config text column of the workflow row
+                    base_workflow = await Workflow.objects.only('id', 'json_file').aget(
+                        pk=selected_character.base_workflow_id)
+                    workflow_capabilities = await sync_to_async(get_workflow_capabilities)(base_workflow)
+                    logger.debug("Workflow capabilities (raw): %s", workflow_capabilities)
 
                     # --- NEW: FILTER CAPABILITIES BASED ON USER PERMISSIONS ---
                     # If user doesn't have permission, disable the capability even if the workflow supports it
@@ -735,60 +1143,65 @@ async def workspace_view(request):
                     if not user_permissions['can_eyedetailer']:
                         workflow_capabilities['can_eyedetailer'] = False
                     # ----------------------------------------------------------
-                    print(f"DEBUG WORKFLOW (FILTERED): {workflow_capabilities}")  # LOG
+                    logger.debug("Workflow capabilities (filtered): %s", workflow_capabilities)
 
                 except Exception as e:
-                    print(f"Error analyzing workflow: {e}")
+                    logger.exception("Error analyzing workflow: %s", e)
 
             # --- CHANGE: Load History ONLY IF REQUESTED ---
             if selected_character and should_load_history:
                 # --- SEPARAR HISTORIAL POR TIPO ---
-                chat_qs = await sync_to_async(list)(
-                    ChatMessage.objects.filter(
-                        user=user,
-                        character=selected_character
-                    ).prefetch_related('generated_images', 'generated_videos').order_by('timestamp')
-                )
-
-                # Format for the template
-                for msg in chat_qs:
-                    item = {
-                        'id': msg.id,  # Needed for deletion
-                        'is_user': msg.is_from_user,
-                        'text': msg.message,
-                        'images': [],
-                        'videos': []  # NUEVO
-                    }
-                    if not msg.is_from_user:
-                        # Get associated images
-                        imgs = await sync_to_async(list)(msg.generated_images.all())
-
-                        # --- PLACEHOLDER LOGIC ---
-                        real_images_count = len(imgs)
-                        expected_count = msg.image_count
-
-                        # First, add the real images
-                        for img in imgs:
-                            # --- CORRECCIÓN: Usar el campo de la BD en lugar de adivinar por nombre ---
-                            img_type = "NORMAL"
-                            if img.generation_type == "Gen_UpScaler":
-                                img_type = "UPSCALER"
-                            elif img.generation_type == "Gen_FaceDetailer":
-                                img_type = "FACEDETAILER"
-                            elif img.generation_type == "Gen_EyeDetailer":
-                                img_type = "EYEDETAILER"
-
-                            item['images'].append({
-                                'url': img.image.url,
-                                'type': img_type,
-                                'width': img.width,  # Pass dimensions
-                                'height': img.height,
-                                'is_deleted': False
+                # Todo el formateo en un solo hop, sobre filas values(): sin instanciar modelos
+                @sync_to_async
+                def build_chat_history():
+                    history_image, history_video = [], []
+                    chat_rows = ChatMessage.objects.filter(user=user, character=selected_character).order_by(
+                        'timestamp').values(
+                        'id', 'is_from_user', 'message', 'image_count', 'chat_type')
+
+                    # Media of the chat's AI messages, one joined query per relation, grouped by message id
+                    # (through-table order = order the media were attached in)
+                    ai_messages = {'chatmessage__user': user, 'chatmessage__character': selected_character,
+                                   'chatmessage__is_from_user': False}
+                    images_by_msg = defaultdict(list)
+                    image_links = ChatMessage.generated_images.through.objects.filter(**ai_messages).order_by('id')
+                    for msg_id, name, generation_type, width, height in image_links.values_list(
+                            'chatmessage_id', 'characterimage__image', 'characterimage__generation_type',
+                            'characterimage__width', 'characterimage__height'):
+                        # --- CORRECCIÓN: Usar el campo de la BD en lugar de adivinar por nombre ---
+                        images_by_msg[msg_id].append({
+                            'url': default_storage.url(name),
+                            'type': HISTORY_IMAGE_TYPES.get(generation_type, "NORMAL"),
+                            'width': width,  # Pass dimensions
+                            'height': height,
+                            'is_deleted': False
+                        })
+
+                    videos_by_msg = defaultdict(list)
+                    video_links = ChatMessage.generated_videos.through.objects.filter(**ai_messages).order_by('id')
+                    for msg_id, video_name, thumbnail in video_links.values_list(
+                            'chatmessage_id', 'generatedvideo__video_file', 'generatedvideo__thumbnail'):
+                        if video_name:
+                            videos_by_msg[msg_id].append({
+                                'url': build_signed_media_url(video_name, user.id, SIGNED_GALLERY_MAX_AGE),
+                                'thumbnail': default_storage.url(thumbnail) if thumbnail else None
                             })
 
-                        # Then fill with placeholders if any are missing
-                        if expected_count > real_images_count:
-                            missing_count = expected_count - real_images_count
+                    # Format for the template
+                    for row in chat_rows:
+                        item = {
+                            'id': row['id'],  # Needed for deletion
+                            'is_user': row['is_from_user'],
+                            'text': row['message'],
+                            'images': [],
+                            'videos': []  # NUEVO
+                        }
+                        if not row['is_from_user']:
+                            # First, the real images
+                            item['images'] = images_by_msg.get(row['id'], [])
+
+                            # --- PLACEHOLDER LOGIC: fill with placeholders if any are missing ---
+                            missing_count = row['image_count'] - len(item['images'])
                             for _ in range(missing_count):
                                 item['images'].append({
                                     'url': None,
@@ -796,20 +1209,18 @@ async def workspace_view(request):
                                     'is_deleted': True
                                 })
 
-                        # --- NUEVO: Get associated videos ---
-                        vids = await sync_to_async(list)(msg.generated_videos.all())
-                        for vid in vids:
-                            if vid.video_file:
-                                item['videos'].append({
-                                    'url': reverse('serve_private_media', kwargs={'path': vid.video_file.name}),
-                                    'thumbnail': vid.thumbnail.url if vid.thumbnail else None
-                                })
+                            # --- NUEVO: Associated videos ---
+                            item['videos'] = videos_by_msg.get(row['id'], [])
+
+                        # Separar en listas distintas
+                        if row['chat_type'] == 'VIDEO':
+                            history_video.append(item)
+                        else:
+                            history_image.append(item)
+
+                    return history_image, history_video
 
-                    # Separar en listas distintas
-                    if msg.chat_type == 'VIDEO':
-                        chat_history_video.append(item)
-                    else:
-                        chat_history_image.append(item)
+                chat_history_image, chat_history_video = await build_chat_history()
 
         except Exception:
             pass
@@ -832,7 +1243,7 @@ async def workspace_view(request):
         'video_qualities': video_qualities,
         'showcase_items': showcase_items,
     }
-    return await sync_to_async(render)(request, 'myapp/workspace.html', context)
+    return TemplateResponse(request, 'myapp/workspace.html', context)
 
 
 # --- NEW: GET MODELS VIEW ---
@@ -840,15 +1251,21 @@ async def get_models_view(request):
     """
     Returns a list of available checkpoints from the active ComfyUI instance.
     """
-    # --- FIX: Use async helper to get user safely ---
-    user = await get_user_from_request(request)
+    # --- FIX: Resolve user asynchronously ---
+    user = await request.auser()
     if not user.is_authenticated:
         return JsonResponse({'status': 'error', 'message': 'Unauthorized'}, status=401)
 
     try:
-        address = await get_active_comfyui_address()
-        info = await get_comfyui_object_info(address)
-        checkpoints = info.get('checkpoints', [])
+        # Checkpoints rarely change: serve them from cache instead of an /object_info round trip per call
+        # (invalidated when a ConnectionConfig changes; empty results, i.e. failed fetches, are not cached)
+        checkpoints = await cache.aget(COMFY_CHECKPOINTS_CACHE_KEY)
+        if checkpoints is None:
+            address = await get_active_comfyui_address()
+            info = await get_comfyui_object_info(address)
+            checkpoints = info.get('checkpoints', [])
+            if checkpoints:
+                await cache.aset(COMFY_CHECKPOINTS_CACHE_KEY, checkpoints, COMFY_CHECKPOINTS_CACHE_TIMEOUT)
         return JsonResponse({'status': 'success', 'checkpoints': checkpoints})
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
@@ -857,7 +1274,7 @@ async def get_models_view(request):
 # --- GENERATE IMAGE VIEW (RESTORED) ---
 async def generate_image_view(request):
     is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-    user = await get_user_from_request(request)
+    user = await request.auser()
 
     if is_ajax:
         if request.method == 'POST':
@@ -865,40 +1282,6 @@ async def generate_image_view(request):
                 return JsonResponse({'status': 'error', 'message': 'You must be logged in to generate images.'},
                                     status=401)
 
-            # --- TOKEN VALIDATION (NEW) ---
-            # Only if not staff (admins have infinite tokens)
-            if not user.is_staff:
-                try:
-                    profile = await sync_to_async(lambda: user.clientprofile)()
-                    await profile.check_and_reset_tokens()
-
-                    # CHANGE: Use async method
-                    tokens_left = await profile.get_tokens_remaining_async()
-                    if tokens_left <= 0:
-                        return JsonResponse({'status': 'error',
-                                             'message': 'You have run out of tokens. Please contact support or wait for your next reset.'},
-                                            status=403)
-                except ClientProfile.DoesNotExist:
-                    # If no profile, create a default one (fallback)
-                    await sync_to_async(ClientProfile.objects.create)(user=user)
-            # ------------------------------------
-
-            # --- REAL RATE LIMITING (CACHE) ---
-            # Use user ID as key, not session.
-            # This prevents clearing cookies to bypass the limit.
-            cache_key = f"gen_limit_image_{user.id}"
-
-            # Check if key exists in cache
-            if cache.get(cache_key):
-                ttl = cache.ttl(cache_key)  # Remaining time
-                return JsonResponse(
-                    {'status': 'error', 'message': f'Please wait {ttl} seconds before generating another image.'},
-                    status=429)
-
-            # Set the lock for 10 seconds
-            cache.set(cache_key, True, timeout=10)
-            # ----------------------------------
-
             character_id = request.POST.get('character_id')
             user_prompt = request.POST.get('prompt')
 
@@ -933,9 +1316,44 @@ async def generate_image_view(request):
                 allowed_types = ["Gen_Normal"]
             # ----------------------------------------------------
 
-            # --- NEW: SECURITY CHECK FOR PERMISSIONS ---
-            user_permissions = await get_user_permissions(user)
+            # --- TOKEN VALIDATION (NEW) ---
+            # Only if not staff (admins have infinite tokens)
+            async def get_generation_tokens_left():
+                if user.is_staff:
+                    return None
+                # CHANGE: profile (created if missing) + reset check + remaining tokens in one hop
+                return await get_tokens_left(user)
 
+            async def get_generation_character():
+                try:
+                    return await Character.objects.select_related('base_workflow').aget(id=character_id)
+                except (Character.DoesNotExist, ValueError):
+                    return None
+
+            # Independent lookups, fetched together; validated below in the usual order
+            tokens_left, user_permissions, character = await asyncio.gather(
+                get_generation_tokens_left(),
+                get_user_permissions(user),  # --- NEW: SECURITY CHECK FOR PERMISSIONS ---
+                get_generation_character()
+            )
+
+            if tokens_left is not None and tokens_left <= 0:
+                return JsonResponse({'status': 'error',
+                                     'message': 'You have run out of tokens. Please contact support or wait for your next reset.'},
+                                    status=403)
+            # ------------------------------------
+
+            # --- REAL RATE LIMITING (CACHE) ---
+            # Use user ID as key, not session.
+            # This prevents clearing cookies to bypass the limit.
+            wait_seconds = acquire_generation_slot('image', user.id)
+            if wait_seconds:
+                return JsonResponse(
+                    {'status': 'error', 'message': f'Please wait {wait_seconds} seconds before generating another image.'},
+                    status=429)
+            # ----------------------------------
+
+            # --- NEW: SECURITY CHECK FOR PERMISSIONS ---
             if generation_type == "Gen_UpScaler" and not user_permissions['can_upscale']:
                 return JsonResponse({'status': 'error', 'message': 'Upscale is not available in your plan.'},
                                     status=403)
@@ -947,125 +1365,128 @@ async def generate_image_view(request):
                                     status=403)
             # -------------------------------------------
 
-            try:
-                character = await sync_to_async(Character.objects.select_related('base_workflow').get)(id=character_id)
+            if character is None:
+                return JsonResponse({'status': 'error', 'message': 'Character not found.'}, status=404)
 
+            try:
                 # --- NEW: PRIVATE CHARACTER QUOTA CHECK ---
                 if character.is_private and not user.is_staff:
-                    try:
-                        access = await sync_to_async(UserCharacterAccess.objects.get)(user=user, character=character)
-                        # await access.check_and_reset_quota() # REMOVED: No quota for private chars anymore
-
-                        # if access.remaining_generations <= 0:
-                        #     return JsonResponse({'status': 'error', 'message': 'You have reached the generation limit for this private character.'}, status=403)
-                    except UserCharacterAccess.DoesNotExist:
+                    # CHANGE: No quota for private chars anymore, so a single EXISTS is enough (no row fetch)
+                    if not await UserCharacterAccess.objects.filter(user=user, character=character).aexists():
                         return JsonResponse(
                             {'status': 'error', 'message': 'You do not have access to this private character.'},
                             status=403)
 
                 # ------------------------------------------
 
-                @sync_to_async
-                def save_user_message():
-                    return ChatMessage.objects.create(user=user, character=character, message=user_prompt,
-                                                      is_from_user=True, chat_type='IMAGE')
-
-                user_msg = await save_user_message()
+                user_msg = await ChatMessage.objects.acreate(user=user, character=character, message=user_prompt,
+                                                             is_from_user=True, chat_type='IMAGE')
 
-                images_data_list, prompt_id, final_workflow_json = await generate_image_from_character(
-                    character, user_prompt, width, height, seed=seed, allowed_types=allowed_types,
-                    checkpoint=checkpoint, lora_strength=lora_strength
+                # On timeout (or client disconnect) the generation is cancelled before any token is deducted
+                images_data_list, prompt_id, final_workflow_json = await asyncio.wait_for(
+                    run_with_generation_slot(lambda: generate_image_from_character(
+                        character, user_prompt, width, height, seed=seed, allowed_types=allowed_types,
+                        checkpoint=checkpoint, lora_strength=lora_strength
+                    )),
+                    timeout=GENERATION_TIMEOUT_SECONDS
                 )
 
                 if images_data_list:
-                    # --- DEDUCT TOKEN (GLOBAL) ---
-                    if not user.is_staff:
-                        @sync_to_async
-                        def deduct_token(u):
-                            p = u.clientprofile
-                            p.tokens_used += 1
-                            p.save()
-
-                        await deduct_token(user)
-
-                        # --- DEDUCT PRIVATE QUOTA (REMOVED) ---
-                        # if character.is_private:
-                        #     @sync_to_async
-                        #     def deduct_private_quota(u, c):
-                        #         try:
-                        #             acc = UserCharacterAccess.objects.get(user=u, character=c)
-                        #             acc.images_generated_current_period += 1
-                        #             acc.save()
-                        #         except UserCharacterAccess.DoesNotExist:
-                        #             pass
-                        #     await deduct_private_quota(user, character)
+                    # --- DEDUCT PRIVATE QUOTA (REMOVED) ---
+                    # if character.is_private:
+                    #     @sync_to_async
+                    #     def deduct_private_quota(u, c):
+                    #         try:
+                    #             acc = UserCharacterAccess.objects.get(user=u, character=c)
+                    #             acc.images_generated_current_period += 1
+                    #             acc.save()
+                    #         except UserCharacterAccess.DoesNotExist:
+                    #             pass
+                    #     await deduct_private_quota(user, character)
                     # -------------------------------
 
                     generated_results = []
-                    created_images = []
 
-                    @sync_to_async
-                    def save_generated_image(img_bytes, classification, index, workflow_json):
+                    # --- NUEVO: Lógica de ocultación ---
+                    hide_from_admin = False
+                    try:
+                        if character.character_config:
+                            config = json.loads(character.character_config)
+                            # Si enable_blacklist es False explícitamente, ocultar imagen
+                            if config.get('enable_blacklist') is False:
+                                hide_from_admin = True
+                    except Exception:
+                        pass
+                    # -----------------------------------
+
+                    # Serialized once for every image of the generation; orjson returns bytes directly
+                    workflow_bytes = orjson.dumps(final_workflow_json, option=orjson.OPT_INDENT_2)
+
+                    def store_generated_image(index, img_bytes, classification):
+                        """Writes the image + workflow files and returns the unsaved row (pure I/O, no DB)."""
                         # CHANGE: Save generation type AND workflow
                         new_image = CharacterImage(
                             character=character,
                             user=user,
                             description=user_prompt,
-                            generation_type=classification  # Save type here
+                            generation_type=classification,  # Save type here
+                            is_hidden_from_admin=hide_from_admin
                         )
 
-                        # --- NUEVO: Lógica de ocultación ---
-                        try:
-                            if character.character_config:
-                                config = json.loads(character.character_config)
-                                # Si enable_blacklist es False explícitamente, ocultar imagen
-                                if config.get('enable_blacklist') is False:
-                                    new_image.is_hidden_from_admin = True
-                        except Exception:
-                            pass
-                        # -----------------------------------
-
                         # Save workflow file
                         workflow_filename = f"workflow_{character.name}_{prompt_id}_{classification}_{index}.json"
-                        new_image.generation_workflow.save(workflow_filename, ContentFile(
-                            json.dumps(workflow_json, indent=2).encode('utf-8')), save=False)
+                        new_image.generation_workflow.save(workflow_filename, ContentFile(workflow_bytes), save=False)
 
                         filename = f"user_gen_{character.name}_{prompt_id}_{classification}_{index}.png"
                         new_image.image.save(filename, ContentFile(img_bytes), save=False)
-                        try:
-                            with PILImage.open(io.BytesIO(img_bytes)) as pil_img:
-                                new_image.width, new_image.height = pil_img.size
-                        except Exception:
-                            pass
-                        new_image.save()
+                        new_image.width, new_image.height = get_image_dimensions(img_bytes)
                         return new_image
 
-                    for i, (img_bytes, classification) in enumerate(images_data_list):
-                        img_obj = await save_generated_image(img_bytes, classification, i, final_workflow_json)
-                        created_images.append(img_obj)
-                        image_url = reverse('serve_private_media', kwargs={'path': img_obj.image.name})
-                        generated_results.append({'url': image_url, 'type': classification, 'width': img_obj.width,
-                                                  'height': img_obj.height})
+                    # Files are written in parallel on the threadpool (pure I/O, outside the transaction)
+                    new_images = await asyncio.gather(*[
+                        asyncio.to_thread(store_generated_image, index, img_bytes, classification)
+                        for index, (img_bytes, classification) in enumerate(images_data_list)
+                    ])
 
                     @sync_to_async
-                    def save_ai_message(imgs):
-                        ai_msg = ChatMessage.objects.create(user=user, character=character,
-                                                            message="Here are your generated images.",
-                                                            is_from_user=False, image_count=len(imgs),
-                                                            chat_type='IMAGE')
-                        ai_msg.generated_images.set(imgs)
-                        return ai_msg
-
-                    ai_msg = await save_ai_message(created_images)
-
-                    return JsonResponse({'status': 'success', 'results': generated_results, 'user_msg_id': user_msg.id,
-                                         'ai_msg_id': ai_msg.id})
+                    def persist_generation(imgs):
+                        # Every write of the generation commits together: one transaction, one commit
+                        with transaction.atomic():
+                            # --- DEDUCT TOKEN (GLOBAL) ---
+                            if not user.is_staff:
+                                # Atomic UPDATE ... SET tokens_used = tokens_used + 1: no lost updates
+                                ClientProfile.objects.filter(user=user).update(tokens_used=F('tokens_used') + 1)
+
+                            # Files are on disk; one INSERT for all rows
+                            imgs = CharacterImage.objects.bulk_create(imgs)
+
+                            ai_msg = ChatMessage.objects.create(user=user, character=character,
+                                                                message="Here are your generated images.",
+                                                                is_from_user=False, image_count=len(imgs),
+                                                                chat_type='IMAGE')
+                            # Brand-new message: insert the link rows directly (set() would SELECT the existing links first)
+                            Through = ChatMessage.generated_images.through
+                            Through.objects.bulk_create(
+                                [Through(chatmessage_id=ai_msg.id, characterimage_id=img.id) for img in imgs])
+                        return imgs, ai_msg
+
+                    created_images, ai_msg = await persist_generation(new_images)
+                    for img_obj in created_images:
+                        # Signed URL: the browser loads it without a permission round-trip
+                        image_url = build_signed_media_url(img_obj.image.name, user.id)
+                        generated_results.append({'url': image_url, 'type': img_obj.generation_type,
+                                                  'width': img_obj.width, 'height': img_obj.height})
+
+                    return OrjsonResponse({'status': 'success', 'results': generated_results,
+                                           'user_msg_id': user_msg.id, 'ai_msg_id': ai_msg.id})
 
                 return JsonResponse({'status': 'error', 'message': 'No valid images generated based on your filters.'},
                                     status=500)
 
-            except Character.DoesNotExist:
-                return JsonResponse({'status': 'error', 'message': 'Character not found.'}, status=404)
+            except asyncio.TimeoutError:
+                return JsonResponse({'status': 'error',
+                                     'message': 'The generation server took too long to respond. Please try again later.'},
+                                    status=504)
             except (httpx.ConnectError, websockets.exceptions.WebSocketException):
                 # Capture specific connection errors
                 return JsonResponse({'status': 'error',
@@ -1073,7 +1494,7 @@ async def generate_image_view(request):
                                     status=503)
             except Exception as e:
                 # For any other error, log the real error on the server console
-                print(f"An unexpected error occurred: {e}")
+                logger.exception("An unexpected error occurred: %s", e)
                 # And show a generic message to the user
                 return JsonResponse({'status': 'error', 'message': 'An unexpected error occurred during generation.'},
                                     status=500)
@@ -1088,48 +1509,51 @@ async def generate_image_view(request):
             try:
                 if media_type == 'video':
                     # Lógica para videos
-                    videos_qs = await sync_to_async(list)(
-                        GeneratedVideo.objects.filter(character_id=character_id, user=user).order_by('-created_at')
-                    )
-                    video_urls = [reverse('serve_private_media', kwargs={'path': v.video_file.name}) for v in videos_qs]
-                    return JsonResponse({'status': 'success', 'videos': video_urls})
+                    video_names = GeneratedVideo.objects.filter(character_id=character_id, user=user).order_by(
+                        '-created_at').values_list('video_file', flat=True)
+                    video_urls = [build_signed_media_url(name, user.id, SIGNED_GALLERY_MAX_AGE)
+                                  async for name in video_names.aiterator(chunk_size=200)]
+                    return OrjsonResponse({'status': 'success', 'videos': video_urls})
                 else:
                     # Lógica existente para imágenes
-                    images_qs = await sync_to_async(list)(
-                        CharacterImage.objects.filter(character_id=character_id, user=user).values_list('image',
-                                                                                                        flat=True).order_by(
-                            '-id')
-                    )
-                    image_urls = [reverse('serve_private_media', kwargs={'path': name}) for name in images_qs]
-                    return JsonResponse({'status': 'success', 'images': image_urls})
+                    # Native async iteration: no threadpool hop, rows streamed in chunks
+                    image_names = CharacterImage.objects.filter(character_id=character_id, user=user).order_by(
+                        '-id').values_list('image', flat=True)
+                    image_urls = [build_signed_media_url(name, user.id, SIGNED_GALLERY_MAX_AGE)
+                                  async for name in image_names.aiterator(chunk_size=200)]
+                    return OrjsonResponse({'status': 'success', 'images': image_urls})
             except Exception as e:
                 return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
     if request.method == 'GET':
-        characters = await get_characters_with_images(user)
-        company_settings = await get_company_settings()
-
-        # --- FIX: Add loading of categories and subcategories ORDERED BY NAME ---
-        all_categories = await sync_to_async(list)(CharacterCategory.objects.all().order_by('name'))
-        all_subcategories = await sync_to_async(list)(CharacterSubCategory.objects.all().order_by('name'))
+        # Las consultas son independientes: las lanzamos a la vez
+        # --- FIX: Add loading of categories and subcategories ORDERED BY NAME (cached) ---
+        characters, company_settings, (all_categories, all_subcategories) = await asyncio.gather(
+            get_characters_with_images(user),
+            get_company_settings(),
+            get_category_lists()
+        )
 
         # --- HERO CAROUSEL LOGIC (NEW) ---
         hero_items = []
         if company_settings:
-            # Get carousel images directly from the HeroCarouselImage model
-            hero_images = await sync_to_async(list)(company_settings.hero_images.all())
-
-            for img in hero_images:
-                hero_items.append({
+            # The carousel is global: build it once and serve it from cache
+            # (invalidated by the HeroCarouselImage / CompanySettings signals in models.py)
+            def build_hero_items():
+                # Get carousel images directly from the HeroCarouselImage model
+                return [{
                     'image_url': img.image.url,
                     'name': img.caption or ""  # Use caption or empty
-                })
+                } for img in HeroCarouselImage.objects.filter(company_settings=company_settings)]
+
+            hero_items = await sync_to_async(cache.get_or_set)(
+                HERO_ITEMS_CACHE_KEY.format(pk=company_settings.pk), build_hero_items, HERO_ITEMS_CACHE_TIMEOUT)
 
         # --- SHOWCASE ITEMS (NEW) ---
         showcase_items = []
         if company_settings:
-            s_items = await sync_to_async(list)(company_settings.showcase_items.all())
-            for item in s_items:
+            # Prefetched (and cached) with the company settings: plain iteration, no query and no threadpool hop
+            for item in company_settings.showcase_items.all():
                 showcase_items.append({
                     'image_url': item.image.url,
                     'prompt': item.prompt
@@ -1143,8 +1567,7 @@ async def generate_image_view(request):
 
         if company_settings and company_settings.is_subscription_active:
             is_subscription_active = True
-            subscription_plans = await sync_to_async(list)(
-                SubscriptionPlan.objects.filter(is_active=True).order_by('price'))
+            subscription_plans = await sync_to_async(cached_subscription_plans)()
 
             # Obtener datos del plan gratuito
             token_settings = await sync_to_async(TokenSettings.load)()
@@ -1183,13 +1606,13 @@ async def generate_image_view(request):
             'free_capabilities': free_capabilities,
             'random_plan_images': random_plan_images,  # Pasamos las imágenes
         }
-        return await sync_to_async(render)(request, 'myapp/generate.html', context)
+        return TemplateResponse(request, 'myapp/generate.html', context)
 
     return redirect('generate_image')
 
 
 async def redeem_coupon_view(request):
-    user = await get_user_from_request(request)
+    user = await request.auser()
     if not user.is_authenticated:
         return JsonResponse({'status': 'error', 'message': 'Unauthorized'}, status=401)
 
@@ -1201,43 +1624,46 @@ async def redeem_coupon_view(request):
         try:
             @sync_to_async
             def process_redemption(user_obj, input_code):
+                # Usage limits are enforced inside the UPDATE itself and double redemption by the unique
+                # constraints, so two users racing for the last slot can't both get it
+                has_free_slot = Q(max_redemptions__isnull=True) | Q(times_redeemed__lt=F('max_redemptions'))
+
                 # 1. Try to redeem as Token/Premium Coupon
                 try:
-                    coupon = Coupon.objects.get(code=input_code)
-
-                    # Check if user already redeemed this coupon
-                    if CouponRedemption.objects.filter(user=user_obj, coupon=coupon).exists():
-                        return {"success": False, "message": "You have already redeemed this coupon."}
-
-                    # Check global limit
-                    if coupon.max_redemptions is not None and coupon.times_redeemed >= coupon.max_redemptions:
-                        return {"success": False, "message": "This coupon has reached its maximum usage limit."}
-
-                    # Process redemption
-                    CouponRedemption.objects.create(user=user_obj, coupon=coupon)
-
-                    # Update coupon stats
-                    coupon.times_redeemed += 1
-                    coupon.save()
-
-                    # Grant tokens (if any)
-                    if coupon.tokens > 0:
-                        profile, _ = ClientProfile.objects.get_or_create(user=user_obj)
-                        profile.bonus_tokens += coupon.tokens
-                        profile.save()
-
-                    # Grant Premium Features (if duration > 0)
-                    if coupon.duration_days > 0:
-                        expires = timezone.now() + timedelta(days=coupon.duration_days)
-                        UserPremiumGrant.objects.create(
-                            user=user_obj,
-                            coupon=coupon,
-                            grant_name=f"Coupon: {coupon.code}",
-                            expires_at=expires,
-                            grant_upscale=coupon.unlock_upscale,
-                            grant_face_detail=coupon.unlock_face_detail,
-                            grant_eye_detail=coupon.unlock_eye_detail
-                        )
+                    with transaction.atomic():
+                        coupon = Coupon.objects.get(code=input_code)
+
+                        # Process redemption (unique user+coupon: a second redemption fails here)
+                        try:
+                            with transaction.atomic():
+                                CouponRedemption.objects.create(user=user_obj, coupon=coupon)
+                        except IntegrityError:
+                            return {"success": False, "message": "You have already redeemed this coupon."}
+
+                        # Update coupon stats, only while under the global limit
+                        if not Coupon.objects.filter(pk=coupon.pk).filter(has_free_slot).update(
+                                times_redeemed=F('times_redeemed') + 1):
+                            transaction.set_rollback(True)
+                            return {"success": False, "message": "This coupon has reached its maximum usage limit."}
+
+                        # Grant tokens (if any): get_or_create absorbs a concurrent profile insert, then an atomic UPDATE
+                        if coupon.tokens > 0:
+                            ClientProfile.objects.get_or_create(user=user_obj)
+                            ClientProfile.objects.filter(user=user_obj).update(
+                                bonus_tokens=F('bonus_tokens') + coupon.tokens)
+
+                        # Grant Premium Features (if duration > 0)
+                        if coupon.duration_days > 0:
+                            expires = timezone.now() + timedelta(days=coupon.duration_days)
+                            UserPremiumGrant.objects.create(
+                                user=user_obj,
+                                coupon=coupon,
+                                grant_name=f"Coupon: {coupon.code}",
+                                expires_at=expires,
+                                grant_upscale=coupon.unlock_upscale,
+                                grant_face_detail=coupon.unlock_face_detail,
+                                grant_eye_detail=coupon.unlock_eye_detail
+                            )
 
                     msg_parts = []
                     if coupon.tokens > 0: msg_parts.append(f"{coupon.tokens} Tokens")
@@ -1250,28 +1676,28 @@ async def redeem_coupon_view(request):
 
                 # 2. Try to redeem as Character Access Code
                 try:
-                    char_code = CharacterAccessCode.objects.get(code=input_code, is_active=True)
-
-                    # --- NEW: Check Global Limit ---
-                    if char_code.max_redemptions is not None and char_code.times_redeemed >= char_code.max_redemptions:
-                        return {"success": False, "message": "This code has reached its maximum usage limit."}
-
-                    # Check if user already has this character
-                    if UserCharacterAccess.objects.filter(user=user_obj, character=char_code.character).exists():
-                        return {"success": False, "message": "You already have access to this character."}
-
-                    # Create access record
-                    UserCharacterAccess.objects.create(
-                        user=user_obj,
-                        character=char_code.character,
-                        source_code=char_code,
-                        # limit_amount=char_code.limit_amount, # REMOVED
-                        # reset_interval=char_code.reset_interval # REMOVED
-                    )
+                    with transaction.atomic():
+                        char_code = CharacterAccessCode.objects.select_related('character').get(code=input_code,
+                                                                                                 is_active=True)
 
-                    # Increment counter
-                    char_code.times_redeemed += 1
-                    char_code.save()
+                        # Create access record (unique user+character: fails if the user already has it)
+                        try:
+                            with transaction.atomic():
+                                UserCharacterAccess.objects.create(
+                                    user=user_obj,
+                                    character=char_code.character,
+                                    source_code=char_code,
+                                    # limit_amount=char_code.limit_amount, # REMOVED
+                                    # reset_interval=char_code.reset_interval # REMOVED
+                                )
+                        except IntegrityError:
+                            return {"success": False, "message": "You already have access to this character."}
+
+                        # --- NEW: Check Global Limit --- (increment counter only while under it)
+                        if not CharacterAccessCode.objects.filter(pk=char_code.pk).filter(has_free_slot).update(
+                                times_redeemed=F('times_redeemed') + 1):
+                            transaction.set_rollback(True)
+                            return {"success": False, "message": "This code has reached its maximum usage limit."}
 
                     return {"success": True, "message": f"Successfully unlocked character: {char_code.character.name}!"}
 
@@ -1291,16 +1717,32 @@ async def redeem_coupon_view(request):
     return JsonResponse({'status': 'error', 'message': 'Method not allowed'}, status=405)
 
 
+# --- PAGOS: CONSTANTES (se construyen una vez por proceso) ---
+# Unidad de periodo de SubscriptionPlan (D, W, M, Y) -> intervalo de Stripe
+STRIPE_INTERVAL_MAP = {
+    'D': 'day',
+    'W': 'week',
+    'M': 'month',
+    'Y': 'year'
+}
+
+
+@functools.lru_cache(maxsize=8)
+def payment_url(name):
+    """reverse() memoizado para las URLs fijas de retorno / IPN de los pagos."""
+    return reverse(name)
+
+
 # --- PAYPAL VIEWS ---
 
 @login_required
 def token_packages(request):
-    company_settings = CompanySettings.objects.last()
+    company_settings = cached_company_settings()
     if company_settings and not company_settings.is_token_sale_active:
         return redirect('profile')
 
-    packages = TokenPackage.objects.filter(is_active=True)
-    characters = Character.objects.filter(is_active=True).prefetch_related('catalog_images_set')
+    packages = cached_token_packages()
+    characters = Character.objects.filter(is_active=True).prefetch_related(CATALOG_IMAGES_PREFETCH)
 
     random_package_images = []
     all_catalog_imgs = []
@@ -1327,7 +1769,7 @@ def token_packages(request):
 @ratelimit(key='ip', rate='10/h', block=True)
 @login_required
 def payment_process(request, package_id):
-    company_settings = CompanySettings.objects.last()  # CAMBIO: .last()
+    company_settings = cached_company_settings()
 
     # --- NEW: Check if token sales are active ---
     if company_settings and not company_settings.is_token_sale_active:
@@ -1344,7 +1786,7 @@ def payment_process(request, package_id):
     )
 
     # --- NUEVO: Generar crypto_amount único si el método cripto está activo ---
-    active_methods = list(PaymentMethod.objects.filter(is_active=True).values_list('config_key', flat=True))
+    active_methods = cached_active_payment_methods()
     if 'crypto' in active_methods:
         # Lógica para monto único: precio base + céntimos aleatorios o basados en ID
         # Limitar explicitamente los céntimos a 6 decimales para que Decimal() en el monitor no falle al comparar
@@ -1355,6 +1797,7 @@ def payment_process(request, package_id):
         transaction.save()
 
     # --- CONFIGURACIÓN DINÁMICA DE PAYPAL DESDE BD ---
+    base_url = f'http://{host}'
     receiver_email = company_settings.paypal_receiver_email if company_settings.paypal_receiver_email else settings.PAYPAL_RECEIVER_EMAIL
 
     paypal_dict = {
@@ -1363,14 +1806,14 @@ def payment_process(request, package_id):
         'item_name': package.name,
         'invoice': str(transaction.id),
         'currency_code': 'USD',
-        'notify_url': f'http://{host}{reverse("paypal-ipn")}',
-        'return_url': f'http://{host}{reverse("payment_done")}',
-        'cancel_return': f'http://{host}{reverse("payment_canceled")}',
+        'notify_url': base_url + payment_url('paypal-ipn'),
+        'return_url': base_url + payment_url('payment_done'),
+        'cancel_return': base_url + payment_url('payment_canceled'),
         'custom': str(transaction.id),  # Pasamos el ID de la transacción para recuperarlo en la señal
     }
 
-    # --- DEBUG LOG ---
-    print(f"DEBUG PAYPAL: Sandbox Mode in DB = {company_settings.paypal_is_sandbox}")
+    # --- DEBUG LOG (solo se formatea si el nivel DEBUG está activo) ---
+    logger.debug("PayPal sandbox=%s", company_settings.paypal_is_sandbox)
 
     # --- USAR CLASE PERSONALIZADA PARA FORZAR ENDPOINT ---
     form = DynamicPayPalForm(initial=paypal_dict, is_sandbox=company_settings.paypal_is_sandbox)
@@ -1400,10 +1843,10 @@ def payment_process(request, package_id):
 # --- NUEVAS VISTAS: PAGO CON CRIPTO ---
 @login_required
 def crypto_payment_process(request, transaction_id):
-    company_settings = CompanySettings.objects.last()
+    company_settings = cached_company_settings()
 
     # Asegurarse de que el método cripto esté activo
-    active_methods = list(PaymentMethod.objects.filter(is_active=True).values_list('config_key', flat=True))
+    active_methods = cached_active_payment_methods()
     if 'crypto' not in active_methods:
         return redirect('token_packages')
 
@@ -1425,18 +1868,16 @@ def crypto_payment_process(request, transaction_id):
 
 @login_required
 def crypto_subscription_process(request, plan_id):
-    company_settings = CompanySettings.objects.last()
-    active_methods = list(PaymentMethod.objects.filter(is_active=True).values_list('config_key', flat=True))
+    company_settings = cached_company_settings()
+    active_methods = cached_active_payment_methods()
     if 'crypto' not in active_methods:
         return redirect('subscription_plans')
 
-    plan = get_object_or_404(SubscriptionPlan, id=plan_id)
+    plan = get_subscription_plan_or_404(plan_id)
 
     # --- ARREGLO DEL BUG: NO SOBRESCRIBIR LA SUSCRIPCIÓN ACTIVA AL NAVEGAR ---
-    try:
-        existing_sub = UserSubscription.objects.get(user=request.user)
-    except UserSubscription.DoesNotExist:
-        existing_sub = UserSubscription.objects.create(user=request.user, plan=plan, status='PENDING')
+    # Igual que en subscription_process: si ya tiene una no se toca; si no, se crea PENDING
+    UserSubscription.objects.get_or_create(user=request.user, defaults={'plan': plan, 'status': 'PENDING'})
 
     import decimal
     import random
@@ -1485,7 +1926,7 @@ def check_payment_status(request, transaction_id):
 @login_required
 def create_checkout_session(request, package_id):
     if request.method == 'POST':
-        company_settings = CompanySettings.objects.last()
+        company_settings = cached_company_settings()
 
         # Obtener clave secreta
         stripe_secret_key = None
@@ -1497,11 +1938,14 @@ def create_checkout_session(request, package_id):
         if not stripe_secret_key:
             return JsonResponse({'error': 'Stripe is not configured correctly.'}, status=500)
 
+        # Import perezoso: el SDK de Stripe solo se carga en los workers que atienden pagos
+        import stripe
         stripe.api_key = stripe_secret_key
 
         package = get_object_or_404(TokenPackage, id=package_id)
         host = request.get_host()
         protocol = "https" if request.is_secure() else "http"
+        base_url = f'{protocol}://{host}'
 
         try:
             checkout_session = stripe.checkout.Session.create(
@@ -1517,8 +1961,8 @@ def create_checkout_session(request, package_id):
                     'quantity': 1,
                 }],
                 mode='payment',
-                success_url=f'{protocol}://{host}{reverse("payment_done")}',
-                cancel_url=f'{protocol}://{host}{reverse("payment_canceled")}',
+                success_url=base_url + payment_url('payment_done'),
+                cancel_url=base_url + payment_url('payment_canceled'),
                 client_reference_id=str(request.request.user.id),  # Para identificar al usuario en el webhook
                 metadata={
                     'package_id': package.id,
@@ -1534,27 +1978,25 @@ def create_checkout_session(request, package_id):
 
 @csrf_exempt
 def payment_done(request):
-    company_settings = CompanySettings.objects.last()  # CAMBIO: .last()
-    return render(request, 'myapp/payment_done.html', {'company': company_settings})
+    return cached_payment_result_page('payment_done')
 
 
 @csrf_exempt
 def payment_canceled(request):
-    company_settings = CompanySettings.objects.last()  # CAMBIO: .last()
-    return render(request, 'myapp/payment_canceled.html', {'company': company_settings})
+    return cached_payment_result_page('payment_canceled')
 
 
 # --- SUBSCRIPTION VIEWS ---
 
 @login_required
 def subscription_plans(request):
-    company_settings = CompanySettings.objects.last()
+    company_settings = cached_company_settings()
 
     if company_settings and not company_settings.is_subscription_active:
         return redirect('profile')
 
-    plans = SubscriptionPlan.objects.filter(is_active=True)
-    characters = Character.objects.filter(is_active=True).prefetch_related('catalog_images_set')
+    plans = cached_subscription_plans()
+    characters = Character.objects.filter(is_active=True).prefetch_related(CATALOG_IMAGES_PREFETCH)
 
     current_sub = None
     try:
@@ -1588,24 +2030,22 @@ def subscription_plans(request):
 @ratelimit(key='ip', rate='10/h', block=True)
 @login_required
 def subscription_process(request, plan_id):
-    company_settings = CompanySettings.objects.last()  # CAMBIO: .last()
+    company_settings = cached_company_settings()
 
     # --- NEW: Check if subscriptions are active ---
     if company_settings and not company_settings.is_subscription_active:
         return redirect('profile')
 
-    plan = get_object_or_404(SubscriptionPlan, id=plan_id)
+    plan = get_subscription_plan_or_404(plan_id)
     host = request.get_host()
 
     # Create or update pending subscription record
     # --- ARREGLO DEL BUG: NO SOBRESCRIBIR LA SUSCRIPCIÓN ACTIVA AL NAVEGAR ---
-    try:
-        sub = UserSubscription.objects.get(user=request.user)
-        # Si ya tiene una, no la tocamos aquí, esperamos a que PayPal avise
-    except UserSubscription.DoesNotExist:
-        sub = UserSubscription.objects.create(user=request.user, plan=plan, status='PENDING')
+    # Si ya tiene una, no la tocamos aquí (esperamos a que PayPal avise); si no, se crea PENDING
+    UserSubscription.objects.get_or_create(user=request.user, defaults={'plan': plan, 'status': 'PENDING'})
 
     # --- CONFIGURACIÓN DINÁMICA DE PAYPAL DESDE BD ---
+    base_url = f'http://{host}'
     receiver_email = company_settings.paypal_receiver_email if company_settings.paypal_receiver_email else settings.PAYPAL_RECEIVER_EMAIL
 
     # PayPal Subscription Parameters
@@ -1618,16 +2058,16 @@ def subscription_process(request, plan_id):
         'src': '1',  # Recurring payments
         'sra': '1',  # Reattempt on failure
         'item_name': plan.name,
-        'invoice': str(uuid.uuid4()),  # Unique invoice ID
+        'invoice': uuid.uuid4().hex,  # Unique invoice ID (32-char hex, no str() round-trip)
         'currency_code': 'USD',
-        'notify_url': f'http://{host}{reverse("paypal-ipn")}',
-        'return_url': f'http://{host}{reverse("subscription_done")}',
-        'cancel_return': f'http://{host}{reverse("subscription_canceled")}',
+        'notify_url': base_url + payment_url('paypal-ipn'),
+        'return_url': base_url + payment_url('subscription_done'),
+        'cancel_return': base_url + payment_url('subscription_canceled'),
         'custom': f"{request.user.id}_{plan.id}",  # Pasamos User ID y Plan ID
     }
 
-    # --- DEBUG LOG ---
-    print(f"DEBUG PAYPAL SUBSCRIPTION: Sandbox Mode in DB = {company_settings.paypal_is_sandbox}")
+    # --- DEBUG LOG (solo se formatea si el nivel DEBUG está activo) ---
+    logger.debug("PayPal subscription sandbox=%s", company_settings.paypal_is_sandbox)
 
     # --- USAR CLASE PERSONALIZADA PARA FORZAR ENDPOINT ---
     form = DynamicPayPalForm(initial=paypal_dict, is_sandbox=company_settings.paypal_is_sandbox)
@@ -1636,7 +2076,7 @@ def subscription_process(request, plan_id):
     paypal_endpoint = form.get_endpoint()
 
     # --- NUEVO: OBTENER MÉTODOS DE PAGO ACTIVOS ---
-    active_methods = list(PaymentMethod.objects.filter(is_active=True).values_list('config_key', flat=True))
+    active_methods = cached_active_payment_methods()
 
     # Stripe Config (Dynamic from DB)
     stripe_key = None
@@ -1662,7 +2102,7 @@ def subscription_process(request, plan_id):
 @login_required
 def create_subscription_checkout_session(request, plan_id):
     if request.method == 'POST':
-        company_settings = CompanySettings.objects.last()
+        company_settings = cached_company_settings()
 
         # Obtener clave secreta
         stripe_secret_key = None
@@ -1674,20 +2114,17 @@ def create_subscription_checkout_session(request, plan_id):
         if not stripe_secret_key:
             return JsonResponse({'error': 'Stripe is not configured correctly.'}, status=500)
 
+        # Import perezoso: el SDK de Stripe solo se carga en los workers que atienden pagos
+        import stripe
         stripe.api_key = stripe_secret_key
 
-        plan = get_object_or_404(SubscriptionPlan, id=plan_id)
+        plan = get_subscription_plan_or_404(plan_id)
         host = request.get_host()
         protocol = "https" if request.is_secure() else "http"
+        base_url = f'{protocol}://{host}'
 
         # Mapear unidad de tiempo de Django a Stripe
-        interval_map = {
-            'D': 'day',
-            'W': 'week',
-            'M': 'month',
-            'Y': 'year'
-        }
-        stripe_interval = interval_map.get(plan.billing_period_unit, 'month')
+        stripe_interval = STRIPE_INTERVAL_MAP.get(plan.billing_period_unit, 'month')
 
         try:
             checkout_session = stripe.checkout.Session.create(
@@ -1707,8 +2144,8 @@ def create_subscription_checkout_session(request, plan_id):
                     'quantity': 1,
                 }],
                 mode='subscription',  # MODO SUSCRIPCIÓN
-                success_url=f'{protocol}://{host}{reverse("subscription_done")}',
-                cancel_url=f'{protocol}://{host}{reverse("subscription_canceled")}',
+                success_url=base_url + payment_url('subscription_done'),
+                cancel_url=base_url + payment_url('subscription_canceled'),
                 client_reference_id=str(request.user.id),
                 metadata={
                     'plan_id': plan.id,
@@ -1724,50 +2161,32 @@ def create_subscription_checkout_session(request, plan_id):
 
 @csrf_exempt
 def subscription_done(request):
-    company_settings = CompanySettings.objects.last()  # CAMBIO: .last()
-    return render(request, 'myapp/subscription_done.html', {'company': company_settings})
+    return cached_payment_result_page('subscription_done')
 
 
 @csrf_exempt
 def subscription_canceled(request):
-    company_settings = CompanySettings.objects.last()  # CAMBIO: .last()
-    return render(request, 'myapp/subscription_canceled.html', {'company': company_settings})
+    return cached_payment_result_page('subscription_canceled')
 
 
 # --- VIDEO GENERATION VIEW (NEW) ---
 async def generate_video_view(request):
     is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-    user = await get_user_from_request(request)
+    user = await request.auser()
 
     if is_ajax and request.method == 'POST':
         if not user.is_authenticated:
             return JsonResponse({'status': 'error', 'message': 'Unauthorized'}, status=401)
 
         # --- RATE LIMITING (VIDEO) ---
-        cache_key = f"gen_limit_video_{user.id}"
-        if cache.get(cache_key):
-            ttl = cache.ttl(cache_key)
+        wait_seconds = acquire_generation_slot('video', user.id)  # 10s limit for videos too
+        if wait_seconds:
             return JsonResponse(
-                {'status': 'error', 'message': f'Please wait {ttl} seconds before generating another video.'},
+                {'status': 'error', 'message': f'Please wait {wait_seconds} seconds before generating another video.'},
                 status=429)
-        cache.set(cache_key, True, timeout=10)  # 10s limit for videos too
         # -----------------------------
 
-        # 1. Validar Tokens (Opcional: definir costo de video)
-        if not user.is_staff:
-            try:
-                profile = await sync_to_async(lambda: user.clientprofile)()
-                await profile.check_and_reset_tokens()
-                tokens_left = await profile.get_tokens_remaining_async()
-                VIDEO_COST = 5  # Ejemplo: Video cuesta 5 tokens
-                if tokens_left < VIDEO_COST:
-                    return JsonResponse(
-                        {'status': 'error', 'message': f'Not enough tokens. Video costs {VIDEO_COST} tokens.'},
-                        status=403)
-            except ClientProfile.DoesNotExist:
-                pass
-
-        # 2. Obtener Datos del Formulario
+        # 1. Obtener Datos del Formulario
         character_id = request.POST.get('character_id')  # NUEVO: Obtener character_id
         prompt = request.POST.get('prompt')
         negative_prompt = request.POST.get('negative_prompt', '')
@@ -1781,32 +2200,40 @@ async def generate_video_view(request):
         if not image_file:
             return JsonResponse({'status': 'error', 'message': 'Image is required.'}, status=400)
 
-        try:
-            # Obtener personaje
-            character = await sync_to_async(Character.objects.get)(id=character_id)
+        # 2. Validar Tokens (Opcional: definir costo de video) y obtener personaje, a la vez
+        VIDEO_COST = 5  # Ejemplo: Video cuesta 5 tokens
 
-            # --- NUEVO: Crear mensaje de usuario (VIDEO) ---
-            @sync_to_async
-            def save_user_message():
-                return ChatMessage.objects.create(
-                    user=user,
-                    character=character,
-                    message=prompt,
-                    is_from_user=True,
-                    chat_type='VIDEO'  # Marcar como video
-                )
+        async def get_video_tokens_left():
+            return None if user.is_staff else await get_tokens_left(user)
 
-            user_msg = await save_user_message()
+        async def get_video_character():
+            try:
+                return await Character.objects.aget(id=character_id)
+            except (Character.DoesNotExist, ValueError):
+                return None
 
-            # 3. Llamar al Servicio de Video
-            # --- CAMBIO: Recibir también el workflow final ---
-            video_bytes, used_seed, filename, final_workflow = await generate_video_task(
-                image_file, prompt, negative_prompt, duration, fps, quality, seed
+        tokens_left, character = await asyncio.gather(get_video_tokens_left(), get_video_character())
+
+        if tokens_left is not None and tokens_left < VIDEO_COST:
+            return JsonResponse(
+                {'status': 'error', 'message': f'Not enough tokens. Video costs {VIDEO_COST} tokens.'},
+                status=403)
+        if character is None:
+            return JsonResponse({'status': 'error', 'message': 'Character not found.'}, status=404)
+
+        try:
+            # --- NUEVO: Crear mensaje de usuario (VIDEO) ---
+            user_msg = await ChatMessage.objects.acreate(
+                user=user,
+                character=character,
+                message=prompt,
+                is_from_user=True,
+                chat_type='VIDEO'  # Marcar como video
             )
 
-            # 4. Guardar Resultado en BD
+            # Guardado del resultado (paso 4): video, tokens y mensaje de IA en un solo hop
             @sync_to_async
-            def save_video_result(v_bytes, v_filename, u_seed, wf_json):
+            def save_video_result(v_path, v_filename, u_seed, wf_json):
                 vid = GeneratedVideo(
                     user=user,
                     character=character,  # Vincular al personaje
@@ -1819,45 +2246,50 @@ async def generate_video_view(request):
                     seed=u_seed
                 )
 
-                # Guardar archivo de video
-                vid.video_file.save(v_filename, ContentFile(v_bytes), save=False)
+                # Guardar archivo de video: copiado por bloques desde el temporal de la descarga
+                with open(v_path, 'rb') as f:
+                    vid.video_file.save(v_filename, File(f), save=False)
 
                 # Guardar archivo de workflow
                 wf_filename = f"workflow_{v_filename}.json"
-                vid.generation_workflow.save(wf_filename, ContentFile(json.dumps(wf_json, indent=2).encode('utf-8')),
+                vid.generation_workflow.save(wf_filename, ContentFile(orjson.dumps(wf_json, option=orjson.OPT_INDENT_2)),
                                              save=False)
 
-                vid.save()
+                # Files are written above; the rows commit together
+                with transaction.atomic():
+                    vid.save()
 
-                # Deduct tokens (si aplica)
-                if not user.is_staff:
-                    try:
-                        p = user.clientprofile
-                        p.tokens_used += 5  # VIDEO_COST hardcoded por ahora
-                        p.save()
-                    except:
-                        pass
+                    # Deduct tokens (si aplica): one atomic UPDATE, no profile SELECT and no lost updates
+                    if not user.is_staff:
+                        if not ClientProfile.objects.filter(user=user).update(tokens_used=F('tokens_used') + VIDEO_COST):
+                            logger.warning("Video tokens not deducted: user %s has no ClientProfile", user.pk)
 
-                return vid
+                    # --- NUEVO: Crear mensaje de IA (VIDEO) ---
+                    ai_message = ChatMessage.objects.create(
+                        user=user,
+                        character=character,
+                        message="Here is your generated video.",
+                        is_from_user=False,
+                        chat_type='VIDEO'
+                    )
+                    ai_message.generated_videos.add(vid)
 
-            video_obj = await save_video_result(video_bytes, filename, used_seed, final_workflow)
+                return vid, ai_message
 
-            # --- NUEVO: Crear mensaje de IA (VIDEO) ---
-            @sync_to_async
-            def save_ai_message(video):
-                ai_msg = ChatMessage.objects.create(
-                    user=user,
-                    character=character,
-                    message="Here is your generated video.",
-                    is_from_user=False,
-                    chat_type='VIDEO'
-                )
-                ai_msg.generated_videos.add(video)
-                return ai_msg
+            # 3. Llamar al Servicio de Video
+            # --- CAMBIO: Recibir también el workflow final ---
+            video_path, used_seed, filename, final_workflow = await generate_video_task(
+                image_file, prompt, negative_prompt, duration, fps, quality, seed
+            )
 
-            ai_msg = await save_ai_message(video_obj)
+            # 4. Guardar Resultado en BD
+            try:
+                video_obj, ai_msg = await save_video_result(video_path, filename, used_seed, final_workflow)
+            finally:
+                # Siempre se borra el temporal de la descarga: también si el guardado falla o se cancela
+                await asyncio.to_thread(discard_temp_file, video_path)
 
-            video_url = reverse('serve_private_media', kwargs={'path': video_obj.video_file.name})
+            video_url = build_signed_media_url(video_obj.video_file.name, user.id)
 
             return JsonResponse({
                 'status': 'success',
@@ -1869,7 +2301,7 @@ async def generate_video_view(request):
 
         except Exception as e:
             # --- SECURITY FIX: Log error to console but show generic message to user ---
-            print(f"Video Generation Error: {e}")
+            logger.exception("Video Generation Error: %s", e)
             return JsonResponse(
                 {'status': 'error', 'message': 'An error occurred during video generation. Please try again later.'},
                 status=500)
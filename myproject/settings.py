@@ -133,6 +133,11 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD', 'mercedes28@'),
         'HOST': os.getenv('DB_HOST', 'localhost'),
         'PORT': os.getenv('DB_PORT', '5432'),
+        # Conexiones persistentes: se reutilizan entre peticiones en vez de abrir una (TCP + auth) por petición.
+        # 0 = cerrar al final de cada petición (p. ej. detrás de PgBouncer o bajo ASGI).
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '60')),
+        # Comprueba la conexión reutilizada antes de usarla (evita errores tras un reinicio de Postgres)
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
@@ -186,6 +191,16 @@ if not DEBUG:
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Entrega de media privada vía nginx (X-Accel-Redirect). Ejemplo: '/protected/'
+# nginx: location /protected/ { internal; alias <MEDIA_ROOT>/; }
+# Si está vacío, Django sirve el archivo con FileResponse (útil en local).
+PRIVATE_MEDIA_ACCEL_PREFIX = os.getenv('PRIVATE_MEDIA_ACCEL_PREFIX', '')
+
+# Máximo de generaciones de imagen simultáneas contra ComfyUI por proceso (el resto espera su turno)
+COMFY_MAX_CONCURRENCY = int(os.getenv('COMFY_MAX_CONCURRENCY', '3'))
+# Tiempo máximo (segundos) de una generación de imagen, incluida la espera en la cola de la GPU
+COMFY_GENERATION_TIMEOUT = int(os.getenv('COMFY_GENERATION_TIMEOUT', '600'))
+
 # Django Allauth Settings
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
@@ -399,10 +414,23 @@ ADMIN_REORDER = (
     },
 )
 
-# CONFIGURACIÓN DE CACHÉ (Para el Rate Limiting)
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
+# CONFIGURACIÓN DE CACHÉ (Rate Limiting + cachés de lectura de myapp invalidadas por señales)
+# Las invalidaciones (post_save / post_delete en models.py) solo llegan a todos los workers si la caché es
+# compartida: con más de un worker gunicorn en producción, REDIS_URL es obligatoria (ej. redis://127.0.0.1:6379/1).
+# Sin ella se usa LocMemCache (una por proceso), válida solo con un único worker o en desarrollo: los demás
+# workers verían un cambio del admin únicamente al expirar el TTL de cada clave.
+REDIS_URL = os.getenv('REDIS_URL', '')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'unique-snowflake',
+        }
     }
-}